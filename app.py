@@ -1,13 +1,34 @@
 """Flask App for Flask Cafe."""
 
-from flask import Flask, render_template, redirect, request, url_for, flash, session, g, jsonify
+from flask import Flask, render_template, redirect, request, url_for, flash, session, g, jsonify, abort, make_response, stream_with_context
 from flask_debugtoolbar import DebugToolbarExtension
+from werkzeug.local import LocalProxy
+from markupsafe import Markup
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import tuple_
 from sqlalchemy.exc import IntegrityError
+import functools
+import math
 import os
 
-from models import db, connect_db, Cafe, City, User, Like, DEFAULT_IMG_URL, DEFAULT_PROFILE_URL
+from models import db, connect_db, Cafe, City, User, Like, MapJob, DEFAULT_IMG_URL, DEFAULT_PROFILE_URL
 from forms import CafeForm, SignupForm, LoginForm, ProfileForm, CSRFProtectionForm
+from mapping import get_map_stats, client as map_client
+from jobs import MapWorkerPool
+from commands import maps_cli, likes_cli, recs_cli
+from geo import cafe_locations
+from search import search_cafes
+from autocomplete import name_index
+from trending import trending
+from recommendations import update_neighbors, get_similar_cafes
+from user_likes import liked_ids
+from user_cache import UserCache
+from passwords import hasher, DEFAULT_WORKERS
+from pagination import paginate, decode_cursor, get_cursor_types, BadCursor
+from query_stats import init_query_stats
+from cache import LRUCache, FragmentCache
+from page_cache import PageCache
+from conditional import make_etag, user_etag_parts, not_modified, add_validators
 
 app = Flask(__name__)
 
@@ -16,13 +37,44 @@ app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY")
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = True
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+# CSRF tokens last as long as the session, so pages embedding one don't
+# change (or need a new ETag) every hour
+app.config['WTF_CSRF_TIME_LIMIT'] = None
+app.config['MAP_WORKERS'] = int(os.environ.get("MAP_WORKERS", 2))
+app.config['CARD_CACHE_SIZE'] = int(os.environ.get("CARD_CACHE_SIZE", 5000))
+app.config['PAGE_CACHE_TTL'] = float(os.environ.get("PAGE_CACHE_TTL", 0))
+app.config['USER_CACHE_TTL'] = float(os.environ.get("USER_CACHE_TTL", 60))
+# bcrypt cost; stored hashes made at another cost are redone on login
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
+app.config['BCRYPT_WORKERS'] = int(os.environ.get("BCRYPT_WORKERS",
+    DEFAULT_WORKERS))
 
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
 db.create_all()
 
-import seed
+init_query_stats(app)
+
+map_workers = MapWorkerPool(app, app.config['MAP_WORKERS'])
+
+@app.before_request
+def start_map_workers():
+    """Start the map workers with the first request, rather than on import
+    (which CLI commands & tests do too)."""
+
+    map_workers.start()
+
+app.cli.add_command(maps_cli)
+app.cli.add_command(likes_cli)
+app.cli.add_command(recs_cli)
+
+card_cache = FragmentCache(LRUCache(max_size=app.config['CARD_CACHE_SIZE']))
+
+# the database is reseeded on every start; set SEED_DB=false to keep it,
+# e.g. when running CLI commands against real data
+if os.environ.get("SEED_DB", "true").lower() != "false":
+    import seed
 
 #######################################
 # auth & auth routes
@@ -31,22 +83,48 @@ CURR_USER_KEY = "curr_user"
 NOT_LOGGED_IN_MSG = "You are not logged in."
 NOT_ADMIN_MSG = "You are not authorized to access this page."
 
+# registered before the hooks below, so cached pages skip them
+page_cache = PageCache(LRUCache(max_size=1000),
+    endpoints=['homepage', 'cafe_list', 'cafe_detail'],
+    user_key=CURR_USER_KEY)
+page_cache.init_app(app)
+
+
+user_cache = UserCache(LRUCache(max_size=10000,
+    ttl=app.config['USER_CACHE_TTL'] or None))
+
+
+def load_curr_user():
+    """Return the logged in user (or None), loading them the first time
+    they're used in a request."""
+
+    if 'curr_user' not in g:
+        g.curr_user = (user_cache.get(session[CURR_USER_KEY])
+            if CURR_USER_KEY in session else None)
+
+    return g.curr_user
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """Add curr user to Flask global, as a proxy that only loads them if
+    they're used."""
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    g.pop('curr_user', None)
+    g.user = LocalProxy(load_curr_user)
 
-    else:
-        g.user = None
+@app.teardown_request
+def count_unused_user(exc):
+    """Count requests by logged in users that never needed the user."""
 
-@app.before_request
-def generate_CSRF_form():
-    """ instantiates CSRF form """
+    if 'user' in g and 'curr_user' not in g and CURR_USER_KEY in session:
+        user_cache.count_not_needed()
+
+@app.context_processor
+def add_csrf_form():
+    """ gives templates a CSRF form, only made (with its token) if a
+    template uses it """
 
-    g.csrf_form = CSRFProtectionForm()
+    return {"csrf_form": LocalProxy(functools.cache(CSRFProtectionForm))}
 
 
 def do_login(user):
@@ -59,7 +137,7 @@ def do_logout():
     """Logout user."""
 
     if CURR_USER_KEY in session:
-        del session[CURR_USER_KEY]
+        user_cache.forget(session.pop(CURR_USER_KEY))
 
 @app.errorhandler(404)
 def not_found(err):
@@ -75,6 +153,20 @@ def signup():
     form = SignupForm()
 
     if form.validate_on_submit():
+        # checked before hashing the password, which is the slow part
+        taken = User.get_taken(username=form.username.data,
+            email=form.email.data)
+
+        if taken["username"]:
+            form.username.errors.append("Username already taken")
+        if taken["email"]:
+            form.email.errors.append("Email already taken")
+
+        if any(taken.values()):
+            flash(form.username.errors[0] if taken["username"]
+                else form.email.errors[0], 'danger')
+            return render_template('/auth/signup-form.html', form=form)
+
         try:
             user = User.register(
                 username = form.username.data,
@@ -94,7 +186,8 @@ def signup():
             return redirect('/cafes')
 
         except IntegrityError:
-            #add db.session.rollback()?
+            # someone else signed up with the same name/email since the check
+            db.session.rollback()
             flash("Username already taken", 'danger')
 
     return render_template('/auth/signup-form.html', form=form)
@@ -109,6 +202,8 @@ def login():
         user = User.authenticate(form.username.data, form.password.data)
 
         if user:
+            # saves the password's new hash, if authenticate rehashed it
+            db.session.commit()
             do_login(user)
 
             flash(f"Hello, {user.username}!", 'success')
@@ -122,7 +217,9 @@ def login():
 def logout():
     """ Logs out user """
 
-    if g.csrf_form.validate_on_submit() and g.user:
+    form = CSRFProtectionForm()
+
+    if form.validate_on_submit() and g.user:
         do_logout()
         flash('You should have successfully logged out.', 'success')
 
@@ -143,27 +240,141 @@ def homepage():
 # cafes
 
 
+CAFES_PER_PAGE = 24
+SEARCH_MAX_PAGE = 20
+
+@app.template_global()
+def cafe_card(cafe):
+    """ Returns HTML of card for cafe, rendering it only if the cafe or its
+    city has changed since it was cached """
+
+    key = f"cafe-card:{cafe.id}:{cafe.version}:{cafe.city.version}"
+    template = app.jinja_env.get_template('cafe/_card.html')
+
+    return Markup(card_cache.get_or_render(key,
+        lambda: template.render(cafe=cafe)))
+
+
+@app.template_global()
+def is_liked(cafe_id):
+    """ Returns True if the current user likes this cafe """
+
+    return bool(g.user) and cafe_id in liked_ids.get(g.user)
+
+
+def filter_cafes(query):
+    """ Returns query narrowed by the filters in the request's args """
+
+    city = request.args.get('city')
+    if city:
+        query = query.where(Cafe.city_code == city)
+
+    return query
+
 @app.get('/cafes')
 def cafe_list():
-    """Return list of all cafes."""
+    """Return list of cafes, a page at a time."""
+
+    query = filter_cafes(db.select(Cafe).options(db.joinedload(Cafe.city)))
 
-    cafes = Cafe.query.order_by('name').all()
+    try:
+        page = paginate(query, [Cafe.name, Cafe.id],
+            after=request.args.get('after'),
+            before=request.args.get('before'),
+            per_page=CAFES_PER_PAGE)
+    except BadCursor:
+        abort(400)
 
-    return render_template(
+    # no Last-Modified: a page also changes when cafes are added or deleted
+    etag = make_etag('cafe-list', request.args.get('city'), page.next,
+        page.prev, user_etag_parts(),
+        [(cafe.id, cafe.version, cafe.city.version) for cafe in page.items])
+
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    resp = make_response(render_template(
         'cafe/list.html',
-        cafes=cafes,
-    )
+        cafes=page.items,
+        page=page,
+    ))
+    return add_validators(resp, etag)
+
+def get_search_page():
+    """ Returns (query, page number) from the request's q & page args """
+
+    page = request.args.get('page', 1, type=int)
+    return request.args.get('q', '').strip(), max(1, min(page, SEARCH_MAX_PAGE))
+
+@app.get('/cafes/search')
+def cafe_search():
+    """Show cafes matching the q arg, best matches first."""
+
+    q, page = get_search_page()
+    cafes = []
+    has_next = False
+
+    if q:
+        # one extra, to tell if there's a next page
+        found = search_cafes(q, limit=CAFES_PER_PAGE + 1,
+            offset=(page - 1) * CAFES_PER_PAGE)
+        has_next = len(found) > CAFES_PER_PAGE and page < SEARCH_MAX_PAGE
+
+        ids = [id for id, rank in found[:CAFES_PER_PAGE]]
+        by_id = {cafe.id: cafe for cafe in db.session.scalars(
+            db.select(Cafe).options(db.joinedload(Cafe.city))
+            .where(Cafe.id.in_(ids)))}
+        cafes = [by_id[id] for id in ids if id in by_id]
+
+    return render_template('cafe/search.html', q=q, cafes=cafes, page=page,
+        has_next=has_next)
+
+POPULAR_LIMIT = 24
+
+def get_popular_cafes(query, limit):
+    """ Returns query for the most liked of the cafes in query (that have
+    any likes), most liked first """
+
+    return (filter_cafes(query)
+        .where(Cafe.like_count > 0)
+        .order_by(Cafe.like_count.desc(), Cafe.id.desc())
+        .limit(limit))
+
+@app.get('/cafes/popular')
+def popular_cafes():
+    """Show the most liked cafes."""
+
+    cafes = db.session.scalars(get_popular_cafes(
+        db.select(Cafe).options(db.joinedload(Cafe.city)), POPULAR_LIMIT))
+
+    return render_template('cafe/popular.html', cafes=cafes)
 
 @app.get('/cafes/<int:cafe_id>')
 def cafe_detail(cafe_id):
     """Show detail for cafe."""
 
-    cafe = Cafe.query.get_or_404(cafe_id)
+    cafe = Cafe.query.options(db.joinedload(Cafe.city)).get_or_404(cafe_id)
+
+    # maps are downloaded in the background; show a placeholder until then
+    map = cafe.get_map()
+    similar = get_similar_cafes(cafe.id)
 
-    map = cafe.save_map()
+    etag = make_etag('cafe-detail', cafe.id, cafe.version, cafe.city.version,
+        cafe.like_count, map, [(row.id, row.version) for row in similar],
+        user_etag_parts())
+    # no Last-Modified: likes, the like count & similar cafes change the
+    # page without changing the cafe's updated_at
 
-    return render_template('/cafe/detail.html',
-        cafe=cafe, map=map)
+    resp = not_modified(etag)
+    if not resp:
+        resp = make_response(render_template('/cafe/detail.html',
+            cafe=cafe, map=map, similar=similar))
+        add_validators(resp, etag)
+
+    # map jobs are queued when cafes are added or moved, not here, so
+    # viewing never writes or retries failed jobs
+    return resp
 
 @app.route('/cafes/add', methods=['GET', 'POST'])
 def add_cafe():
@@ -191,7 +402,9 @@ def add_cafe():
         )
 
         db.session.add(cafe)
+        MapJob.enqueue(cafe)
         db.session.commit()
+        map_workers.wake()
 
         flash(f'{cafe.name} added!', 'success')
         redirect_url=url_for('cafe_detail', cafe_id=cafe.id)
@@ -220,7 +433,12 @@ def edit_cafe(cafe_id):
         form.populate_obj(cafe)
         cafe.image_url = form.image_url.data or DEFAULT_IMG_URL
 
+        if cafe.location_changed():
+            cafe.latitude = cafe.longitude = None
+            MapJob.enqueue(cafe)
+
         db.session.commit()
+        map_workers.wake()
 
         flash(f'{cafe.name} edited!', 'success')
         redirect_url = url_for('cafe_detail', cafe_id=cafe.id)
@@ -239,7 +457,13 @@ def user_profile():
         flash(NOT_LOGGED_IN_MSG, 'danger')
         return redirect('/')
 
-    return render_template('/profile/detail.html')
+    # only what the list shows, rather than every liked Cafe
+    liked_cafes = db.session.execute(db.select(Cafe.id, Cafe.name)
+        .join(Like, Like.cafe_id == Cafe.id)
+        .where(Like.user_id == g.user.id)
+        .order_by(Cafe.name)).all()
+
+    return render_template('/profile/detail.html', liked_cafes=liked_cafes)
 
 @app.route('/profile/edit', methods=['GET', 'POST'])
 def edit_user():
@@ -256,6 +480,7 @@ def edit_user():
         g.user.image_url = form.image_url.data or DEFAULT_PROFILE_URL
 
         db.session.commit()
+        user_cache.forget(session[CURR_USER_KEY])
 
         flash('Profile edited!', 'success')
         redirect_url = url_for('user_profile')
@@ -277,21 +502,28 @@ def like_cafe():
     if request.method == 'GET':
         cafe_id = request.args.get('cafe_id')
 
+        etag = make_etag('likes', g.user.id, g.user.likes_version, cafe_id)
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
         cafe = Cafe.query.get_or_404(cafe_id)
 
-        status = cafe in g.user.liked_cafes
-        return jsonify(likes=status)
+        status = cafe.id in liked_ids.get(g.user)
+        return add_validators(jsonify(likes=status), etag)
 
     cafe_id = request.get_json()['cafe_id']
 
     cafe = Cafe.query.get_or_404(cafe_id)
-    g.user.liked_cafes.append(cafe)
+    if Like.add(g.user.id, cafe.id):
+        update_neighbors(g.user.id, cafe.id)
+        g.user.likes_version = User.likes_version + 1
 
     db.session.commit()
+    user_cache.forget(session[CURR_USER_KEY])
     return (jsonify(liked=cafe_id), 201)
 
 
-
 @app.post('/api/unlike')
 def unlike_cafe():
     """ Removes cafe from user's likes list and returns JSON"""
@@ -300,12 +532,409 @@ def unlike_cafe():
         return {"error": "Not logged in"}
 
     cafe_id = request.get_json()['cafe_id']
-    like = Like.query.get_or_404((g.user.id, cafe_id))
 
-    db.session.delete(like)
+    if not Like.remove(g.user.id, cafe_id):
+        abort(404)
+
+    update_neighbors(g.user.id, cafe_id)
+    g.user.likes_version = User.likes_version + 1
     db.session.commit()
+    user_cache.forget(session[CURR_USER_KEY])
 
     return (jsonify(unliked=cafe_id), 201)
 
+LIKE_STATUS_MAX_IDS = 500
+
+@app.post('/api/likes/status')
+def like_statuses():
+    """ Takes JSON of {"cafe_ids": [...]} and returns JSON of whether user
+    likes each cafe, like {"likes": {"1": true, "2": false}} """
+
+    if not g.user:
+        return ({"error": "Not logged in"}, 401)
+
+    cafe_ids = (request.get_json(silent=True) or {}).get('cafe_ids')
+
+    if (not isinstance(cafe_ids, list)
+            or not all(type(id) is int for id in cafe_ids)):
+        return ({"error": "cafe_ids must be a list of ids"}, 400)
+
+    if len(cafe_ids) > LIKE_STATUS_MAX_IDS:
+        return ({"error": f"At most {LIKE_STATUS_MAX_IDS} cafe_ids"}, 400)
+
+    liked = liked_ids.get(g.user)
+
+    return jsonify(likes={id: id in liked for id in cafe_ids})
+
+@app.route('/api/cafes/<int:cafe_id>/like', methods=['PUT', 'DELETE'])
+def set_cafe_like(cafe_id):
+    """ Likes (PUT) or unlikes (DELETE) cafe, doing nothing if that's
+    already so, and returns JSON of the like status & cafe's like count
+
+    Doesn't load the user's liked cafes, so takes the same time however
+    many cafes they like. """
+
+    if not g.user:
+        return ({"error": "Not logged in"}, 401)
+
+    liked = request.method == 'PUT'
+
+    try:
+        if liked:
+            changed = Like.add(g.user.id, cafe_id)
+        else:
+            changed = Like.remove(g.user.id, cafe_id)
+    except IntegrityError:
+        db.session.rollback()
+        return ({"error": "Not found"}, 404)
+
+    if changed:
+        update_neighbors(g.user.id, cafe_id)
+        # in SQL, so concurrent likes by the same user can't lose a bump
+        g.user.likes_version = User.likes_version + 1
+
+    count = Like.count_for(cafe_id)
+    if count is None:
+        db.session.rollback()
+        return ({"error": "Not found"}, 404)
+
+    db.session.commit()
+    if changed:
+        user_cache.forget(session[CURR_USER_KEY])
+
+    return jsonify(liked=liked, count=count)
+
+
+#######################################
+# Cafes API
+
+CAFE_API_FIELDS = {column.key: column for column in [Cafe.id, Cafe.name,
+    Cafe.description, Cafe.url, Cafe.address, Cafe.city_code, Cafe.image_url,
+    Cafe.latitude, Cafe.longitude, Cafe.updated_at, Cafe.like_count]}
+CAFE_API_DEFAULT_FIELDS = ['id', 'name', 'description', 'url', 'address',
+    'city_code', 'image_url']
+CAFE_API_MAX_PER_PAGE = 100
+CAFE_API_STREAM_BATCH = 1000
+
+def get_cafe_fields():
+    """ Returns list of field names asked for in the fields arg (e.g.
+    ?fields=id,name), or raises ValueError for unknown fields """
+
+    if not request.args.get('fields'):
+        return CAFE_API_DEFAULT_FIELDS
+
+    fields = request.args['fields'].split(',')
+    unknown = set(fields) - set(CAFE_API_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    return fields
+
+def stream_cafes(query, fields, format):
+    """ Yields chunks of JSON for all cafes in query, as NDJSON or one JSON
+    array, reading rows from the database a batch at a time """
+
+    rows = db.session.execute(
+        query.execution_options(yield_per=CAFE_API_STREAM_BATCH))
+
+    if format == 'json':
+        yield '{"cafes":['
+
+    for i, row in enumerate(rows):
+        cafe = app.json.dumps({field: row._mapping[field] for field in fields})
+
+        if format == 'ndjson':
+            yield cafe + '\n'
+        else:
+            yield cafe if i == 0 else ',' + cafe
+
+    if format == 'json':
+        yield ']}'
+
+def paginate_stream(query):
+    """ Returns query ordered for streaming, starting after the after
+    cursor if one was given """
+
+    columns = [Cafe.name, Cafe.id]
+    query = query.order_by(*columns)
+
+    after = request.args.get('after')
+    if after:
+        values = decode_cursor(after, get_cursor_types(columns))
+        query = query.where(tuple_(*columns) > tuple_(*values))
+
+    return query
+
+@app.get('/api/cafes')
+def list_cafes_api():
+    """ Returns JSON of a page of cafes, ordered by name, with cursors for
+    the next and previous pages
+
+    Takes the same filters as the cafe list, plus fields to pick which
+    fields to return. stream=ndjson or stream=json returns every cafe at
+    once (after the after cursor, if given), streamed as it's read. """
+
+    try:
+        fields = get_cafe_fields()
+    except ValueError as exc:
+        return ({"error": str(exc)}, 400)
+
+    # name & id are needed for cursors, whatever fields were asked for
+    columns = [CAFE_API_FIELDS[field]
+        for field in dict.fromkeys(['id', 'name', *fields])]
+    query = filter_cafes(db.select(*columns))
+
+    stream = request.args.get('stream')
+    if stream:
+        if stream not in ('ndjson', 'json'):
+            return ({"error": "stream must be ndjson or json"}, 400)
+
+        try:
+            query = paginate_stream(query)
+        except BadCursor:
+            return ({"error": "Invalid cursor"}, 400)
+
+        mimetype = ('application/x-ndjson' if stream == 'ndjson'
+            else 'application/json')
+        return app.response_class(
+            stream_with_context(stream_cafes(query, fields, stream)),
+            mimetype=mimetype)
+
+    per_page = request.args.get('per_page', CAFES_PER_PAGE, type=int)
+    per_page = max(1, min(per_page, CAFE_API_MAX_PER_PAGE))
+
+    try:
+        page = paginate(query, [Cafe.name, Cafe.id],
+            after=request.args.get('after'),
+            before=request.args.get('before'),
+            per_page=per_page,
+            scalars=False)
+    except BadCursor:
+        return ({"error": "Invalid cursor"}, 400)
+
+    return jsonify(
+        cafes=[{field: row._mapping[field] for field in fields}
+            for row in page.items],
+        next=page.next,
+        prev=page.prev,
+    )
+
+@app.get('/api/cafes/search')
+def search_cafes_api():
+    """ Returns JSON of cafes matching the q arg, best matches first, each
+    with its rank; takes fields like the cafe list API """
+
+    try:
+        fields = get_cafe_fields()
+    except ValueError as exc:
+        return ({"error": str(exc)}, 400)
+
+    q, page = get_search_page()
+    if not q:
+        return ({"error": "q is required"}, 400)
+
+    per_page = request.args.get('per_page', CAFES_PER_PAGE, type=int)
+    per_page = max(1, min(per_page, CAFE_API_MAX_PER_PAGE))
+
+    found = search_cafes(q, limit=per_page, offset=(page - 1) * per_page)
+
+    columns = [CAFE_API_FIELDS[field]
+        for field in dict.fromkeys(['id', *fields])]
+    rows = db.session.execute(db.select(*columns)
+        .where(Cafe.id.in_([id for id, rank in found])))
+    cafes = {row.id: row for row in rows}
+
+    return jsonify(cafes=[
+        dict({field: cafes[id]._mapping[field] for field in fields}, rank=rank)
+        for id, rank in found if id in cafes
+    ])
+
+@app.get('/api/cafes/popular')
+def popular_cafes_api():
+    """ Returns JSON of the most liked cafes, most liked first, with their
+    like counts; takes fields and filters like the cafe list API """
+
+    try:
+        fields = get_cafe_fields()
+    except ValueError as exc:
+        return ({"error": str(exc)}, 400)
+
+    limit = request.args.get('limit', POPULAR_LIMIT, type=int)
+    limit = max(1, min(limit, CAFE_API_MAX_PER_PAGE))
+
+    fields = list(dict.fromkeys([*fields, 'like_count']))
+    rows = db.session.execute(get_popular_cafes(
+        db.select(*[CAFE_API_FIELDS[field] for field in fields]), limit))
+
+    return jsonify(cafes=[row._asdict() for row in rows])
+
+@app.get('/api/cafes/trending')
+def trending_cafes_api():
+    """ Returns JSON of the cafes liked most lately, optionally only in the
+    city arg, with their scores (likes, each counting half as much every
+    week); takes fields like the cafe list API """
+
+    try:
+        fields = get_cafe_fields()
+    except ValueError as exc:
+        return ({"error": str(exc)}, 400)
+
+    limit = request.args.get('limit', POPULAR_LIMIT, type=int)
+    limit = max(1, min(limit, CAFE_API_MAX_PER_PAGE))
+
+    found = trending.top(limit, request.args.get('city'))
+
+    columns = [CAFE_API_FIELDS[field]
+        for field in dict.fromkeys(['id', *fields])]
+    rows = db.session.execute(db.select(*columns)
+        .where(Cafe.id.in_([id for id, score in found])))
+    cafes = {row.id: row for row in rows}
+
+    return jsonify(cafes=[
+        dict({field: cafes[id]._mapping[field] for field in fields},
+            score=round(score, 3))
+        for id, score in found if id in cafes
+    ])
+
+@app.get('/api/cafes/<int:cafe_id>/similar')
+def similar_cafes_api(cafe_id):
+    """ Returns JSON of cafes liked by the same people as this one, most
+    similar first """
+
+    if not db.session.get(Cafe, cafe_id):
+        return ({"error": "Not found"}, 404)
+
+    return jsonify(cafes=[
+        {"id": row.id, "name": row.name, "score": round(row.score, 3),
+            "co_likes": row.co_likes}
+        for row in get_similar_cafes(cafe_id)
+    ])
+
+@app.get('/api/cafes/<int:cafe_id>')
+def show_cafe_api(cafe_id):
+    """ Returns JSON of one cafe; takes fields like the cafe list API """
+
+    try:
+        fields = get_cafe_fields()
+    except ValueError as exc:
+        return ({"error": str(exc)}, 400)
+
+    row = db.session.execute(
+        db.select(*[CAFE_API_FIELDS[field] for field in fields])
+        .where(Cafe.id == cafe_id)).first()
+
+    if row is None:
+        return ({"error": "Not found"}, 404)
+
+    return jsonify(cafe=row._asdict())
+
+NEARBY_RADIUS_KM = 5
+NEARBY_MAX_RESULTS = 100
+
+@app.get('/api/cafes/nearby')
+def nearby_cafes():
+    """ Returns JSON of cafes near lat & lng, nearest first
+
+    Finds cafes within radius km (default 5), or the nearest limit cafes
+    if only limit is given. """
+
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    radius = request.args.get('radius', type=float)
+    limit = request.args.get('limit', NEARBY_MAX_RESULTS, type=int)
+
+    # float() accepts "nan" & "inf", which get past comparisons
+    if (lat is None or lng is None
+            or not math.isfinite(lat) or not math.isfinite(lng)
+            or abs(lat) > 90 or abs(lng) > 180):
+        return ({"error": "Valid lat and lng are required"}, 400)
+
+    if ((radius is not None and not (math.isfinite(radius) and radius > 0))
+            or limit <= 0):
+        return ({"error": "radius and limit must be positive"}, 400)
+
+    limit = min(limit, NEARBY_MAX_RESULTS)
+
+    if radius is None and 'limit' in request.args:
+        found = cafe_locations.nearest(lat, lng, limit)
+    else:
+        found = cafe_locations.within(lat, lng, radius or NEARBY_RADIUS_KM,
+            limit)
+
+    rows = db.session.execute(
+        db.select(Cafe.id, Cafe.name, Cafe.address, Cafe.city_code)
+        .where(Cafe.id.in_([id for dist, id in found])))
+    cafes = {row.id: row for row in rows}
+
+    return jsonify(cafes=[
+        dict(cafes[id]._asdict(), distance_km=round(dist, 3))
+        for dist, id in found if id in cafes
+    ])
+
+
+#######################################
+# Autocomplete API
+
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 25
+
+@app.get('/api/autocomplete')
+def autocomplete():
+    """ Returns JSON of cafes and cities whose names (or a word in them)
+    start with the q arg, with a url for each """
+
+    q = request.args.get('q', '')
+    limit = request.args.get('limit', AUTOCOMPLETE_LIMIT, type=int)
+    limit = max(1, min(limit, AUTOCOMPLETE_MAX_LIMIT))
+
+    results = []
+    for kind, id, name in name_index.complete(q, limit):
+        if kind == "cafe":
+            url = url_for('cafe_detail', cafe_id=id)
+        else:
+            url = url_for('cafe_list', city=id)
+        results.append({"type": kind, "id": id, "name": name, "url": url})
+
+    return jsonify(results=results)
+
+
+#######################################
+# Users API
+
+@app.get('/api/users/available')
+def users_available():
+    """ Returns JSON of whether the username and/or email args are free to
+    sign up with, e.g. {"username": true, "email": false} """
+
+    username = request.args.get('username') or None
+    email = request.args.get('email') or None
+
+    if username is None and email is None:
+        return ({"error": "Give a username or email"}, 400)
+
+    taken = User.get_taken(username=username, email=email)
+    return jsonify({name: not is_taken for name, is_taken in taken.items()})
+
+
+#######################################
+# Stats API
+
+@app.get('/api/stats')
+def show_stats():
+    """ Returns JSON of cache and mapping counters (admins only) """
+
+    if not g.user or not g.user.admin:
+        return ({"error": "Not authorized"}, 403)
+
+    return jsonify(
+        maps=get_map_stats(),
+        map_client=map_client.get_stats(),
+        card_cache=card_cache.get_stats(),
+        page_cache=page_cache.get_stats(),
+        liked_ids=liked_ids.get_stats(),
+        users=user_cache.get_stats(),
+        passwords=hasher.get_stats(),
+    )
+
 
 # when
@@ -0,0 +1,160 @@
+"""Autocomplete for cafe and city names.
+
+Names are kept in sorted arrays in memory, so the names starting with a
+prefix are found with a binary search rather than a LIKE query on every
+keystroke.
+"""
+
+import bisect
+import unicodedata
+
+from indexes import SyncedIndex, get_identity
+from models import db, Cafe, City
+
+
+def normalize(text):
+    """Return text lowercased, without accents and with single spaces, so
+    "Café  Réveille" matches "cafe rev"."""
+
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(text.split())
+
+
+class SortedNames:
+    """Prefix lookup of names, by whole name and by later words in them.
+
+    Entries are (key, kind, id, name) tuples in two sorted lists: one keyed
+    by the whole name, one by each later word onwards (so "roa" finds
+    "Mission Roastery").
+    """
+
+    def __init__(self):
+        self.names = []
+        self.words = []
+        self.entries = {}
+
+    def _keys(self, name):
+        """Return (whole name key, [later word keys]) for name."""
+
+        key = normalize(name)
+        words = key.split(" ")
+        later = [" ".join(words[i:]) for i in range(1, len(words))]
+        return key, later
+
+    def add(self, kind, id, name):
+        """Add (or rename) an entry."""
+
+        self.remove(kind, id)
+
+        key, later = self._keys(name)
+        bisect.insort(self.names, (key, kind, id, name))
+        for word_key in later:
+            bisect.insort(self.words, (word_key, kind, id, name))
+
+        self.entries[kind, id] = name
+
+    def remove(self, kind, id):
+        """Remove an entry, if it's there."""
+
+        name = self.entries.pop((kind, id), None)
+        if name is None:
+            return
+
+        key, later = self._keys(name)
+        _discard(self.names, (key, kind, id, name))
+        for word_key in later:
+            _discard(self.words, (word_key, kind, id, name))
+
+    def complete(self, prefix, limit):
+        """Return up to limit [(kind, id, name)] starting with prefix: names
+        that start with it first, then names with a later word that does,
+        each alphabetically."""
+
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+
+        found = {}
+
+        for entries in (self.names, self.words):
+            i = bisect.bisect_left(entries, (prefix,))
+
+            while (len(found) < limit and i < len(entries)
+                    and entries[i][0].startswith(prefix)):
+                key, kind, id, name = entries[i]
+                found.setdefault((kind, id), name)
+                i += 1
+
+        return [(kind, id, name) for (kind, id), name in found.items()]
+
+    def build(self, entries):
+        """Replace contents with [(kind, id, name)], sorting once."""
+
+        self.entries = {(kind, id): name for kind, id, name in entries}
+        self.names = []
+        self.words = []
+
+        for (kind, id), name in self.entries.items():
+            key, later = self._keys(name)
+            self.names.append((key, kind, id, name))
+            self.words.extend((word_key, kind, id, name) for word_key in later)
+
+        self.names.sort()
+        self.words.sort()
+
+
+def _discard(entries, entry):
+    """Remove entry from the sorted list entries, if it's there."""
+
+    i = bisect.bisect_left(entries, entry)
+    if i < len(entries) and entries[i] == entry:
+        del entries[i]
+
+
+class NameIndex(SyncedIndex):
+    """Sorted names of cafes and cities."""
+
+    models = (Cafe, City)
+
+    def __init__(self):
+        super().__init__()
+        self.names = SortedNames()
+
+    def load(self):
+        names = SortedNames()
+
+        names.build(
+            [("cafe", id, name)
+                for id, name in db.session.execute(db.select(Cafe.id, Cafe.name))]
+            + [("city", code, name)
+                for code, name in db.session.execute(db.select(City.code, City.name))])
+
+        self.names = names
+
+    def snapshot(self, op, obj):
+        kind = "cafe" if isinstance(obj, Cafe) else "city"
+
+        if op == "delete":
+            return kind, get_identity(obj), None
+        if kind == "cafe":
+            return kind, obj.id, obj.name
+        return kind, obj.code, obj.name
+
+    def apply(self, op, data):
+        kind, id, name = data
+
+        if name is None:
+            self.names.remove(kind, id)
+        else:
+            self.names.add(kind, id, name)
+
+    def complete(self, prefix, limit):
+        """Return up to limit [(kind, id, name)] matching prefix."""
+
+        self.ensure_loaded()
+        with self._lock:
+            return self.names.complete(prefix, limit)
+
+
+name_index = NameIndex()
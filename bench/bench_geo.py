@@ -0,0 +1,75 @@
+"""Benchmark radius and nearest-cafe queries on the spatial grid index.
+
+    python -m bench.bench_geo --cafes 100000
+
+Cafes are spread at random over a metro-sized area; reports p50/p95/p99
+per-query latency for a few radii and k values.
+"""
+
+import argparse
+import random
+import time
+
+from bench.bench_mapping import percentile
+from geo import GridIndex
+
+# roughly the SF Bay Area
+LAT_RANGE = (37.2, 38.2)
+LNG_RANGE = (-122.6, -121.6)
+
+
+def random_point(rng):
+    """Return a random (lat, lng) in the benchmark area."""
+
+    return rng.uniform(*LAT_RANGE), rng.uniform(*LNG_RANGE)
+
+
+def measure(name, query, points):
+    """Time query at each point and print percentiles."""
+
+    latencies = []
+    results = 0
+
+    for lat, lng in points:
+        start = time.perf_counter()
+        results += len(query(lat, lng))
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    ms = [percentile(latencies, pct) * 1000 for pct in (50, 95, 99)]
+    print(f"{name:<18} {ms[0]:>9.3f} {ms[1]:>9.3f} {ms[2]:>9.3f} "
+        f"{results / len(points):>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cafes", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    grid = GridIndex()
+
+    start = time.perf_counter()
+    for id in range(args.cafes):
+        grid.add(id, *random_point(rng))
+    print(f"indexed {args.cafes} cafes in "
+        f"{time.perf_counter() - start:.2f}s ({len(grid.cells)} cells)\n")
+
+    points = [random_point(rng) for i in range(args.queries)]
+
+    print(f"{'query':<18} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+        f"{'results':>10}")
+
+    for radius in (0.25, 0.5, 1):
+        measure(f"within {radius}km",
+            lambda lat, lng: grid.within(lat, lng, radius, limit=100), points)
+
+    for k in (1, 10, 50):
+        measure(f"nearest {k}",
+            lambda lat, lng: grid.nearest(lat, lng, k), points)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Benchmark the mapping layer against the local MapQuest stub.
+
+    python -m bench.bench_mapping --latency 50 --concurrency 1 8 32
+
+Reports p50/p95/p99 latency and throughput for building map URLs, cold
+downloads, map store hits, and ETag revalidation, at each concurrency.
+Nothing is sent to the real MapQuest.
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import mapping
+from bench.mapquest_stub import start_stub
+
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of a sorted list of samples."""
+
+    if not samples:
+        return float("nan")
+    index = min(len(samples) - 1, round(pct / 100 * (len(samples) - 1)))
+    return samples[index]
+
+
+def timed(fn, *args, **kwargs):
+    """Call fn, returning (seconds taken, whether it succeeded)."""
+
+    start = time.perf_counter()
+    try:
+        ok = fn(*args, **kwargs) is not None
+    except Exception:
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def run(fn, calls, concurrency):
+    """Make calls (a list of (args, kwargs)) to fn on a pool of threads.
+
+    Returns (sorted latencies, wall clock seconds, error count).
+    """
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda call: timed(fn, *call[0], **call[1]),
+            calls))
+
+    wall = time.perf_counter() - start
+    latencies = sorted(seconds for seconds, ok in results)
+    errors = sum(not ok for seconds, ok in results)
+    return latencies, wall, errors
+
+
+def report(name, concurrency, latencies, wall, errors):
+    """Print one row of results."""
+
+    ms = [percentile(latencies, pct) * 1000 for pct in (50, 95, 99)]
+    print(f"{name:<22} {concurrency:>5} {len(latencies):>7} "
+        f"{ms[0]:>9.3f} {ms[1]:>9.3f} {ms[2]:>9.3f} "
+        f"{len(latencies) / wall:>10.1f} {errors:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200,
+        help="maps to fetch per scenario")
+    parser.add_argument("--concurrency", type=int, nargs="+",
+        default=[1, 8, 32])
+    parser.add_argument("--latency", type=float, default=20,
+        help="stub latency in milliseconds")
+    parser.add_argument("--jitter", type=float, default=10,
+        help="stub jitter in milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--payload-size", type=int, default=20_000)
+    args = parser.parse_args()
+
+    stub = start_stub(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        error_rate=args.error_rate,
+        payload_size=args.payload_size)
+    mapping.BASE_URL = stub.base_url
+
+    print(f"{'scenario':<22} {'conc':>5} {'calls':>7} {'p50 ms':>9} "
+        f"{'p95 ms':>9} {'p99 ms':>9} {'calls/s':>10} {'errors':>6}")
+
+    for concurrency in args.concurrency:
+        maps_dir = tempfile.mkdtemp()
+        mapping.client = mapping.MapClient(pool_size=concurrency)
+
+        addresses = [(f"{i} Bench St {concurrency}", "sf", "CA")
+            for i in range(args.requests)]
+        store = {"maps_dir": maps_dir}
+
+        scenarios = [
+            ("get_map_url", mapping.get_map_url, {}),
+            ("save_map (miss)", mapping.save_map, store),
+            ("save_map (hit)", mapping.save_map, store),
+            ("save_map (304)", mapping.save_map, {**store, "force": True}),
+            ("lookup_map", mapping.lookup_map, store),
+        ]
+
+        try:
+            for name, fn, kwargs in scenarios:
+                calls = [(address, kwargs) for address in addresses]
+                report(name, concurrency, *run(fn, calls, concurrency))
+        finally:
+            shutil.rmtree(maps_dir)
+
+    print(f"\nstub requests: {stub.requests}")
+    print(f"map client: {mapping.client.get_stats()}")
+    stub.shutdown()
+
+
+if __name__ == "__main__":
+    main()
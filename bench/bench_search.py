@@ -0,0 +1,141 @@
+"""Benchmark full-text cafe search.
+
+    python -m bench.bench_search --cafes 100000
+    python -m bench.bench_search --cafes 100000 --database-url postgresql:///flaskcafe
+
+Cafes get names, descriptions and addresses of random words, drawn so that
+a few words are common and most are rare, like real text. Reports p50/p95/
+p99 latency of one- and two-word queries on the in-process inverted index
+and, given --database-url, on PostgreSQL (the tsvector column and its GIN
+index). PostgreSQL cafes are added in a transaction that's rolled back.
+"""
+
+import argparse
+import random
+import time
+
+from flask import Flask
+
+from bench.bench_mapping import percentile
+from models import db, connect_db, Cafe, City, make_search_vector
+from search import InvertedIndex, search_cafes
+
+VOCABULARY_SIZE = 20_000
+RESULTS_LIMIT = 24
+
+
+def make_vocabulary(rng):
+    """Return list of made-up words, and Zipf-like weights for them."""
+
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = sorted({"".join(rng.choices(letters, k=rng.randint(4, 9)))
+        for i in range(VOCABULARY_SIZE)})
+    rng.shuffle(words)
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+    return words, weights
+
+
+def make_cafes(rng, count, words, weights):
+    """Return list of dicts of name, description & address."""
+
+    def text(k):
+        return " ".join(rng.choices(words, weights, k=k))
+
+    return [{
+        "name": text(rng.randint(1, 3)),
+        "description": text(rng.randint(8, 30)),
+        "address": f"{rng.randint(1, 9999)} {text(1)} St",
+    } for i in range(count)]
+
+
+def measure(name, search, queries):
+    """Time search for each query and print percentiles."""
+
+    latencies = []
+    results = 0
+
+    for query in queries:
+        start = time.perf_counter()
+        results += len(search(query))
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    ms = [percentile(latencies, pct) * 1000 for pct in (50, 95, 99)]
+    print(f"{name:<26} {ms[0]:>9.3f} {ms[1]:>9.3f} {ms[2]:>9.3f} "
+        f"{results / len(queries):>8.1f}")
+
+
+def bench_postgres(database_url, cafes, query_sets):
+    """Load cafes into PostgreSQL and time search_cafes."""
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    connect_db(app)
+    db.create_all()
+
+    try:
+        db.session.add(City(code="bench", name="Bench", state="CA"))
+        db.session.flush()
+
+        start = time.perf_counter()
+        db.session.execute(db.insert(Cafe),
+            [dict(cafe, url="", city_code="bench") for cafe in cafes])
+        # inserted without the ORM, so fill in the vectors here
+        db.session.execute(db.update(Cafe)
+            .where(Cafe.city_code == "bench")
+            .values(search_vector=make_search_vector(
+                Cafe.name, Cafe.description, Cafe.address)))
+        db.session.execute(db.text("ANALYZE cafes"))
+        print(f"postgres: loaded {len(cafes)} cafes in "
+            f"{time.perf_counter() - start:.2f}s\n")
+
+        for name, queries in query_sets:
+            measure(f"postgres {name}",
+                lambda q: search_cafes(q, limit=RESULTS_LIMIT), queries)
+
+    finally:
+        db.session.rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cafes", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database-url",
+        help="also benchmark PostgreSQL search in this database")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    words, weights = make_vocabulary(rng)
+    cafes = make_cafes(rng, args.cafes, words, weights)
+
+    # queries skip the few most common words, which nobody searches for
+    searchable = words[10:]
+    query_sets = [
+        ("1 word", [rng.choice(searchable) for i in range(args.queries)]),
+        ("2 words", [" ".join(rng.choices(searchable, weights[10:], k=2))
+            for i in range(args.queries)]),
+    ]
+
+    index = InvertedIndex()
+    start = time.perf_counter()
+    for id, cafe in enumerate(cafes):
+        index.add(id, cafe)
+    print(f"inverted index: indexed {args.cafes} cafes in "
+        f"{time.perf_counter() - start:.2f}s ({len(index.postings)} words)\n")
+
+    print(f"{'query':<26} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+        f"{'results':>8}")
+
+    for name, queries in query_sets:
+        measure(f"index {name}",
+            lambda q: index.search(q, limit=RESULTS_LIMIT), queries)
+
+    if args.database_url:
+        print()
+        bench_postgres(args.database_url, cafes, query_sets)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""Local stand-in for the MapQuest static map API.
+
+Serves fake JPEG maps with configurable latency, error rate and size, so
+mapping code can be exercised and benchmarked offline:
+
+    python -m bench.mapquest_stub --latency 50 --error-rate 0.05
+
+then run the app with BASE_URL=http://127.0.0.1:8765/staticmap/v5/map and
+GEOCODE_URL=http://127.0.0.1:8765/geocoding/v1/address. Maps get a stable
+ETag per URL, and If-None-Match is answered with a 304. Geocoding puts
+every location at a stable point in the San Francisco Bay Area.
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_PORT = 8765
+JPEG_HEADER = b"\xff\xd8\xff\xe0"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers every GET with a fake map for the requested URL."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        server.count_request()
+
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if random.random() < server.error_rate:
+            self._send(503, b"stub error")
+            return
+
+        digest = hashlib.sha1(self.path.encode()).digest()
+
+        if self.path.startswith("/geocoding/"):
+            self._send_location(digest)
+            return
+
+        etag = f'"{digest.hex()[:16]}"'
+
+        if self.headers.get("If-None-Match") == etag:
+            self._send(304, b"", {"ETag": etag})
+            return
+
+        # deterministic payload, so the same URL always gets the same map
+        filler = digest * (server.payload_size // len(digest) + 1)
+        body = (JPEG_HEADER + filler)[:server.payload_size]
+
+        self._send(200, body, {
+            "Content-Type": "image/jpeg",
+            "ETag": etag,
+            "Last-Modified": "Mon, 02 Jan 2023 00:00:00 GMT",
+        })
+
+    def _send_location(self, digest):
+        """Send a geocoding result at a point chosen by digest."""
+
+        lat = 37.6 + digest[0] / 255 * 0.3
+        lng = -122.5 + digest[1] / 255 * 0.3
+        body = json.dumps({"results": [{"locations": [
+            {"latLng": {"lat": lat, "lng": lng}},
+        ]}]}).encode()
+
+        self._send(200, body, {"Content-Type": "application/json"})
+
+    def _send(self, status, body, headers=None):
+        """Send a response with a body and extra headers."""
+
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Don't log every request."""
+
+
+class StubServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the stub's settings."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, latency=0.0, jitter=0.0, error_rate=0.0,
+            payload_size=20_000):
+        super().__init__(address, StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.payload_size = payload_size
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def count_request(self):
+        """Count a request made to the stub."""
+
+        with self._lock:
+            self.requests += 1
+
+    @property
+    def base_url(self):
+        """Return the URL to use as the app's BASE_URL."""
+
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/staticmap/v5/map"
+
+    @property
+    def geocode_url(self):
+        """Return the URL to use as the app's GEOCODE_URL."""
+
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/geocoding/v1/address"
+
+
+def start_stub(host="127.0.0.1", port=0, **settings):
+    """Start a stub server in a background thread and return it.
+
+    Port 0 picks a free port; see server.base_url.
+    """
+
+    server = StubServer((host, port), **settings)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--latency", type=float, default=0,
+        help="milliseconds to wait before answering")
+    parser.add_argument("--jitter", type=float, default=0,
+        help="up to this many extra milliseconds, at random")
+    parser.add_argument("--error-rate", type=float, default=0,
+        help="fraction of requests answered with a 503")
+    parser.add_argument("--payload-size", type=int, default=20_000,
+        help="size of each map in bytes")
+    args = parser.parse_args()
+
+    server = StubServer((args.host, args.port),
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        error_rate=args.error_rate,
+        payload_size=args.payload_size)
+
+    print(f"Serving fake maps; use BASE_URL={server.base_url} "
+        f"GEOCODE_URL={server.geocode_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Caches for Flask Cafe."""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """In-process cache of at most max_size entries, evicting the least
+    recently used. Entries may also expire after ttl seconds.
+
+    Other backends (e.g. one shared between processes) can be used in its
+    place by anything with the same get/set/add/delete/clear methods.
+    """
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return value cached for key, or default if missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Cache value for key, for ttl seconds (or the cache's default)."""
+
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        """Cache value for key only if nothing is cached for it yet.
+
+        Returns True if it was added, so it can serve as a lock.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None
+                    or entry[1] > time.monotonic()):
+                return False
+
+            self._set(key, value, ttl)
+            return True
+
+    def _set(self, key, value, ttl):
+        """Cache value for key; the caller must hold the lock."""
+
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        """Remove key from the cache, if present."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove everything from the cache."""
+
+        with self._lock:
+            self._entries.clear()
+
+
+class FragmentCache:
+    """Rendered template fragments, kept in a cache backend.
+
+    Keys should include a version of everything the fragment shows, so
+    that changing it makes a new key rather than needing the old entry
+    found and deleted.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, key, render):
+        """Return fragment cached for key, calling render() on a miss."""
+
+        fragment = self.backend.get(key)
+
+        if fragment is None:
+            self.misses += 1
+            fragment = render()
+            self.backend.set(key, fragment)
+        else:
+            self.hits += 1
+
+        return fragment
+
+    def clear(self):
+        """Remove all fragments and reset the counters."""
+
+        self.backend.clear()
+        self.hits = self.misses = 0
+
+    def get_stats(self):
+        """Return dict of hit/miss counts and hit rate."""
+
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "size": len(self.backend) if hasattr(self.backend, '__len__') else None,
+        }
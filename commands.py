@@ -0,0 +1,177 @@
+"""CLI commands for Flask Cafe."""
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from models import db, Cafe, City, Like
+from mapping import save_map
+from recommendations import rebuild_neighbors, NEIGHBORS_PER_CAFE
+
+maps_cli = AppGroup('maps', help="Manage stored cafe maps.")
+likes_cli = AppGroup('likes', help="Manage cafe likes.")
+recs_cli = AppGroup('recs', help="Manage cafe recommendations.")
+
+REBUILD_PROGRESS_FILE = 'maps-rebuild.json'
+
+
+def get_progress_path():
+    """Return path of the file recording how far a rebuild has got."""
+
+    return os.path.join(current_app.instance_path, REBUILD_PROGRESS_FILE)
+
+
+def read_progress():
+    """Return id of the last cafe a previous rebuild finished, or 0."""
+
+    try:
+        with open(get_progress_path()) as fp:
+            return json.load(fp)['last_cafe_id']
+    except (FileNotFoundError, ValueError, KeyError):
+        return 0
+
+
+def write_progress(last_cafe_id):
+    """Record that every cafe up to last_cafe_id has been rebuilt."""
+
+    os.makedirs(current_app.instance_path, exist_ok=True)
+
+    path = get_progress_path()
+    with open(path + '.tmp', 'w') as fp:
+        json.dump({'last_cafe_id': last_cafe_id}, fp)
+    os.replace(path + '.tmp', path)
+
+
+def clear_progress():
+    """Forget any previous rebuild progress."""
+
+    try:
+        os.unlink(get_progress_path())
+    except FileNotFoundError:
+        pass
+
+
+def iter_cafe_batches(after_id, batch_size):
+    """Yield lists of (id, address, city_code, state) for cafes with ids
+    after after_id, in id order.
+
+    Rows are streamed from a server-side cursor rather than loaded at once.
+    """
+
+    query = (db.select(Cafe.id, Cafe.address, Cafe.city_code, City.state)
+        .join(City)
+        .where(Cafe.id > after_id)
+        .order_by(Cafe.id)
+        .execution_options(yield_per=batch_size))
+
+    for partition in db.session.execute(query).partitions():
+        yield [tuple(row) for row in partition]
+
+
+@maps_cli.command('rebuild')
+@click.option('--workers', default=8, show_default=True,
+    help="Number of maps to download at once.")
+@click.option('--batch-size', default=200, show_default=True,
+    help="Number of cafes to read and checkpoint at a time.")
+@click.option('--force', is_flag=True,
+    help="Revalidate stored maps, downloading them again if changed.")
+@click.option('--restart', is_flag=True,
+    help="Ignore progress from an interrupted run and start over.")
+def rebuild_maps(workers, batch_size, force, restart):
+    """Download maps for every cafe, resuming an interrupted run."""
+
+    if restart:
+        clear_progress()
+
+    after_id = read_progress()
+    if after_id:
+        click.echo(f"Resuming after cafe {after_id}")
+
+    def fetch(cafe):
+        id, address, city_code, state = cafe
+        try:
+            return save_map(address, city_code, state, force=force)
+        except Exception as exc:
+            click.echo(f"Cafe {id}: {exc}", err=True)
+            return None
+
+    done = failed = 0
+    start = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch in iter_cafe_batches(after_id, batch_size):
+            urls = list(pool.map(fetch, batch))
+
+            done += len(urls)
+            failed += urls.count(None)
+            write_progress(batch[-1][0])
+
+            elapsed = time.monotonic() - start
+            rate = done / elapsed if elapsed else 0
+            click.echo(f"{done} maps in {elapsed:.1f}s ({rate:.1f}/s), "
+                f"{failed} failed")
+
+    clear_progress()
+
+    if failed:
+        click.echo("Run again to retry the failed maps.")
+    else:
+        click.echo("Done")
+
+
+# how many drifted cafes reconcile lists by name
+DRIFT_REPORT_LIMIT = 20
+
+
+@likes_cli.command('reconcile')
+@click.option('--dry-run', is_flag=True,
+    help="Report drift without fixing it.")
+def reconcile_likes(dry_run):
+    """Recount every cafe's likes, reporting and fixing any drift."""
+
+    recount = (db.select(db.func.count())
+        .where(Like.cafe_id == Cafe.id)
+        .scalar_subquery())
+
+    drifted = db.session.execute(
+        db.select(Cafe.id, Cafe.like_count, recount)
+        .where(Cafe.like_count != recount)
+        .order_by(Cafe.id)).all()
+
+    for id, stored, actual in drifted[:DRIFT_REPORT_LIMIT]:
+        click.echo(f"Cafe {id}: {stored} likes counted, {actual} actual")
+
+    off_by = sum(abs(stored - actual) for id, stored, actual in drifted)
+    click.echo(f"{len(drifted)} cafes drifted, off by {off_by} likes in all")
+
+    if not drifted or dry_run:
+        return
+
+    # recounted in one statement, in case likes changed since the report
+    db.session.execute(db.update(Cafe)
+        .where(Cafe.like_count != recount)
+        .values(like_count=recount, updated_at=Cafe.updated_at)
+        .execution_options(skip_index_reset=True,
+            synchronize_session=False))
+    db.session.commit()
+
+    click.echo("Fixed")
+
+
+@recs_cli.command('build')
+@click.option('--neighbors', default=NEIGHBORS_PER_CAFE, show_default=True,
+    help="Number of similar cafes to keep for each cafe.")
+def build_recs(neighbors):
+    """Rebuild every cafe's similar cafes from all likes."""
+
+    start = time.monotonic()
+    count = rebuild_neighbors(neighbors)
+    db.session.commit()
+
+    click.echo(f"Stored {count} similar cafes in "
+        f"{time.monotonic() - start:.1f}s")
@@ -0,0 +1,78 @@
+"""Conditional GET support (ETag / Last-Modified) for Flask Cafe.
+
+Routes work out validators for what they would show, cheaply and before
+rendering anything, then:
+
+    cached = not_modified(etag, last_modified)
+    if cached:
+        return cached
+
+    resp = make_response(render_template(...))
+    return add_validators(resp, etag, last_modified)
+"""
+
+import hashlib
+import time
+
+from flask import current_app, g, request, session, make_response
+from werkzeug.http import is_resource_modified
+
+
+def make_etag(*parts):
+    """Return an ETag for everything a response depends on."""
+
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def user_etag_parts():
+    """Return the parts of the logged in user that every page shows."""
+
+    if not g.user:
+        return (None,)
+
+    parts = (g.user.id, g.user.get_full_name(), g.user.admin,
+        g.user.likes_version)
+
+    # pages for users embed a CSRF token (in the logout form); if tokens
+    # expire, make pages revalidate well before they do
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    if limit:
+        parts += (int(time.time() // (limit / 2)),)
+
+    return parts
+
+
+def not_modified(etag, last_modified=None):
+    """Return a 304 response if the client's copy is current, else None.
+
+    Pages with flashed messages waiting are never answered with a 304, as
+    the client's copy wouldn't show them.
+    """
+
+    if '_flashes' in session:
+        return None
+
+    if is_resource_modified(request.environ, etag=etag,
+            last_modified=last_modified):
+        return None
+
+    return add_validators(make_response('', 304), etag, last_modified)
+
+
+def add_validators(response, etag, last_modified=None):
+    """Set ETag, Last-Modified and Cache-Control on response."""
+
+    response.set_etag(etag)
+
+    if last_modified:
+        response.last_modified = last_modified
+
+    # caches may keep the page, but must check it's current before use
+    response.cache_control.no_cache = True
+    if g.get('user'):
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+
+    response.vary.add('Cookie')
+    return response
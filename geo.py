@@ -0,0 +1,211 @@
+"""Spatial index of cafe locations, for radius and nearest-cafe queries."""
+
+import heapq
+import math
+
+from indexes import SyncedIndex, get_identity
+from models import db, Cafe
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# about 2km; small enough that a radius query scans few cafes it won't return
+CELL_SIZE = 0.02
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Return great-circle distance in km between two points."""
+
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex:
+    """Points bucketed into square cells of cell_size degrees.
+
+    Queries only look at cells near the query point, so their cost depends
+    on how many points are nearby rather than on how many there are.
+    """
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.points = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def _cell(self, lat, lng):
+        """Return (row, col) of the cell containing a point."""
+
+        return (math.floor(lat / self.cell_size),
+            math.floor(lng / self.cell_size))
+
+    def add(self, id, lat, lng):
+        """Add a point, or move it if it is already in the index."""
+
+        self.remove(id)
+        self.points[id] = (lat, lng)
+
+        # keep what distance calculations need, so queries don't redo it
+        lat_r, lng_r = math.radians(lat), math.radians(lng)
+        self.cells.setdefault(self._cell(lat, lng), {})[id] = (
+            lat_r, lng_r, math.cos(lat_r))
+
+    def remove(self, id):
+        """Remove a point, if it is in the index."""
+
+        point = self.points.pop(id, None)
+        if point is None:
+            return
+
+        cell = self._cell(*point)
+        del self.cells[cell][id]
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def _scan(self, cells, lat, lng):
+        """Return [(distance, id)] for every point in these cells."""
+
+        lat_r, lng_r = math.radians(lat), math.radians(lng)
+        cos_lat = math.cos(lat_r)
+        sin, asin, sqrt = math.sin, math.asin, math.sqrt
+        diameter = 2 * EARTH_RADIUS_KM
+
+        found = []
+        for cell in cells:
+            for id, (plat, plng, pcos) in self.cells.get(cell, {}).items():
+                a = (sin((plat - lat_r) / 2) ** 2
+                    + cos_lat * pcos * sin((plng - lng_r) / 2) ** 2)
+                found.append((diameter * asin(min(1.0, sqrt(a))), id))
+
+        return found
+
+    def _lng_scale(self, lat, dlat):
+        """Return km per degree of longitude at the widest latitude
+        within dlat degrees of lat (so spans computed from it are never
+        too small)."""
+
+        widest = min(90.0, abs(lat) + dlat)
+        return KM_PER_DEGREE * max(math.cos(math.radians(widest)), 1e-6)
+
+    def within(self, lat, lng, radius_km, limit=None):
+        """Return [(distance, id)] of points within radius_km, nearest first."""
+
+        dlat = radius_km / KM_PER_DEGREE
+        dlng = radius_km / self._lng_scale(lat, dlat)
+
+        row_lo, col_lo = self._cell(lat - dlat, lng - dlng)
+        row_hi, col_hi = self._cell(lat + dlat, lng + dlng)
+
+        if (row_hi - row_lo + 1) * (col_hi - col_lo + 1) > len(self.cells):
+            cells = list(self.cells)
+        else:
+            cells = [(row, col)
+                for row in range(row_lo, row_hi + 1)
+                for col in range(col_lo, col_hi + 1)]
+
+        found = [(dist, id) for dist, id in self._scan(cells, lat, lng)
+            if dist <= radius_km]
+
+        if limit is not None:
+            return heapq.nsmallest(limit, found)
+        return sorted(found)
+
+    def nearest(self, lat, lng, k):
+        """Return [(distance, id)] of the k nearest points, nearest first.
+
+        Searches rings of cells outward from the point's cell until no
+        unsearched cell can hold anything nearer than what's been found.
+        """
+
+        if k <= 0 or not self.points:
+            return []
+
+        row, col = self._cell(lat, lng)
+        found = []
+        ring = 0
+
+        while True:
+            if (2 * ring + 1) ** 2 > len(self.cells):
+                # searched area is bigger than the occupied one; scan it all
+                return heapq.nsmallest(k,
+                    self._scan(list(self.cells), lat, lng))
+
+            if ring == 0:
+                cells = [(row, col)]
+            else:
+                cells = [(r, c)
+                    for r in range(row - ring, row + ring + 1)
+                    for c in range(col - ring, col + ring + 1)
+                    if max(abs(r - row), abs(c - col)) == ring]
+
+            found.extend(self._scan(cells, lat, lng))
+
+            # any point outside the searched rings is at least as far away
+            # as the nearest edge of the searched area
+            size = self.cell_size
+            dlat = min(lat - (row - ring) * size, (row + ring + 1) * size - lat)
+            dlng = min(lng - (col - ring) * size, (col + ring + 1) * size - lng)
+            reach = min(dlat * KM_PER_DEGREE,
+                dlng * self._lng_scale(lat, (ring + 1) * size))
+
+            if len(found) >= k:
+                nearest = heapq.nsmallest(k, found)
+                if nearest[-1][0] <= reach:
+                    return nearest
+
+            ring += 1
+
+
+class CafeLocationIndex(SyncedIndex):
+    """Grid index of geocoded cafes."""
+
+    models = (Cafe,)
+
+    def __init__(self, cell_size=CELL_SIZE):
+        super().__init__()
+        self.grid = GridIndex(cell_size)
+
+    def load(self):
+        grid = GridIndex(self.grid.cell_size)
+
+        query = (db.select(Cafe.id, Cafe.latitude, Cafe.longitude)
+            .where(Cafe.latitude.is_not(None), Cafe.longitude.is_not(None)))
+
+        for id, lat, lng in db.session.execute(query):
+            grid.add(id, lat, lng)
+
+        self.grid = grid
+
+    def snapshot(self, op, cafe):
+        if op == "delete":
+            return get_identity(cafe), None, None
+        return cafe.id, cafe.latitude, cafe.longitude
+
+    def apply(self, op, data):
+        id, lat, lng = data
+
+        if lat is None or lng is None:
+            self.grid.remove(id)
+        else:
+            self.grid.add(id, lat, lng)
+
+    def within(self, lat, lng, radius_km, limit=None):
+        """Return [(distance, cafe id)] of cafes within radius_km."""
+
+        self.ensure_loaded()
+        with self._lock:
+            return self.grid.within(lat, lng, radius_km, limit)
+
+    def nearest(self, lat, lng, k):
+        """Return [(distance, cafe id)] of the k nearest cafes."""
+
+        self.ensure_loaded()
+        with self._lock:
+            return self.grid.nearest(lat, lng, k)
+
+
+cafe_locations = CafeLocationIndex()
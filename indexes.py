@@ -0,0 +1,150 @@
+"""In-memory indexes kept in step with the database.
+
+An index is loaded from the database the first time it's used, then kept
+current from ORM changes as they are committed. Changes made by other
+processes (or by bulk Query.update/delete, which bypass the ORM) are
+picked up by reloading after max_age seconds, or right away for bulk
+changes made in this process.
+"""
+
+import threading
+import time
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+_indexes = []
+
+PENDING_KEY = "index_changes"
+
+
+class SyncedIndex:
+    """Base class for an in-memory index of some models' rows.
+
+    Subclasses set models and implement load(), snapshot() and apply().
+    """
+
+    models = ()
+    max_age = 300
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded_at = None
+        _indexes.append(self)
+
+    def load(self):
+        """Replace the index's contents with rows from the database."""
+
+        raise NotImplementedError
+
+    def snapshot(self, op, obj):
+        """Return the data the index needs from a changed instance.
+
+        Called during flush. For deletes the row is already gone, so only
+        the instance's identity (see get_identity) is safe to use.
+        """
+
+        return obj
+
+    def apply(self, op, data):
+        """Update the index for a committed change; op is 'insert', 'update'
+        or 'delete' and data is what snapshot() returned."""
+
+        raise NotImplementedError
+
+    def ensure_loaded(self):
+        """Load the index if it hasn't been, or is too old."""
+
+        with self._lock:
+            if (self._loaded_at is None
+                    or time.monotonic() - self._loaded_at > self.max_age):
+                self.load()
+                self._loaded_at = time.monotonic()
+
+    def reset(self):
+        """Forget the index's contents; it's reloaded on next use."""
+
+        with self._lock:
+            self._loaded_at = None
+
+    def _apply(self, op, data):
+        """Apply a committed change, if the index is loaded."""
+
+        with self._lock:
+            if self._loaded_at is not None:
+                self.apply(op, data)
+
+
+def get_identity(obj):
+    """Return the primary key of a persistent or deleted instance, without
+    loading anything."""
+
+    return inspect(obj).identity[0]
+
+
+def _watching(model):
+    """Return the indexes that watch this model."""
+
+    return [index for index in _indexes if issubclass(model, index.models)]
+
+
+def record_change(session, op, obj):
+    """Snapshot a change for the indexes that watch obj's model, to apply
+    on commit.
+
+    Flushed changes are recorded automatically; call this for rows changed
+    with Core statements, passing a transient instance holding the row's
+    values.
+    """
+
+    pending = session.info.setdefault(PENDING_KEY, [])
+
+    for index in _watching(type(obj)):
+        pending.append((index, op, index.snapshot(op, obj)))
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_changes(session, flush_context):
+    """Snapshot flushed instances that indexes watch, to apply on commit."""
+
+    for op, objs in (("insert", session.new), ("update", session.dirty),
+            ("delete", session.deleted)):
+        for obj in objs:
+            if op == "update" and not session.is_modified(obj):
+                continue
+
+            record_change(session, op, obj)
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_changes(session):
+    """Apply changes to indexes once they are committed."""
+
+    for index, op, data in session.info.pop(PENDING_KEY, []):
+        index._apply(op, data)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_changes(session, previous_transaction):
+    """Throw away changes that were rolled back."""
+
+    session.info.pop(PENDING_KEY, None)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _reset_on_bulk_change(orm_execute_state):
+    """Reset indexes whose models are changed by bulk UPDATE or DELETE,
+    which don't go through flush."""
+
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+
+    if orm_execute_state.execution_options.get("skip_index_reset"):
+        return
+
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None:
+        return
+
+    for index in _watching(mapper.class_):
+        index.reset()
@@ -0,0 +1,134 @@
+"""Background map jobs for Flask Cafe."""
+
+import threading
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from mapping import client, CircuitOpenError
+from models import db, MapJob
+
+MAX_ATTEMPTS = 5
+BACKOFF_SECONDS = 30
+LEASE_SECONDS = 300
+POLL_SECONDS = 10
+
+
+def get_backoff(attempts):
+    """Return how long to wait before retrying a job that has failed
+    this many times."""
+
+    return timedelta(seconds=BACKOFF_SECONDS * 2 ** (attempts - 1))
+
+
+def run_next_job():
+    """Claim the next due map job, download its map and geocode its cafe.
+
+    Returns False if there was no job due.
+    """
+
+    now = datetime.utcnow()
+
+    job = (MapJob.query
+        .filter(MapJob.status == 'pending', MapJob.run_after <= now)
+        .order_by(MapJob.run_after)
+        .with_for_update(skip_locked=True)
+        .first())
+
+    if not job:
+        db.session.rollback()
+        return False
+
+    # lease the job before doing slow work, so other workers skip it and
+    # it is retried if we die holding it
+    job.attempts += 1
+    job.run_after = now + timedelta(seconds=LEASE_SECONDS)
+    db.session.commit()
+
+    try:
+        cafe = job.cafe
+
+        cafe.save_map()
+
+        if cafe.latitude is None and not cafe.geocode():
+            raise RuntimeError("geocoding failed")
+
+    except CircuitOpenError as exc:
+        # MapQuest is down, not this job: wait for the breaker to let calls
+        # through again, without using up an attempt
+        job.attempts -= 1
+        job.last_error = str(exc)
+        job.run_after = datetime.utcnow() + timedelta(
+            seconds=client.breaker.reset_timeout)
+
+    except Exception as exc:
+        current_app.logger.warning("map job for cafe %s failed: %s",
+            job.cafe_id, exc)
+        job.last_error = str(exc)
+
+        if job.attempts >= MAX_ATTEMPTS:
+            job.status = 'failed'
+        else:
+            job.run_after = datetime.utcnow() + get_backoff(job.attempts)
+
+    else:
+        job.status = 'done'
+        job.last_error = None
+
+    db.session.commit()
+    return True
+
+
+class MapWorkerPool:
+    """Threads that run queued map jobs in the background."""
+
+    def __init__(self, app, size):
+        self.app = app
+        self.size = size
+        self._threads = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def start(self):
+        """Start the workers if they aren't running yet, so they pick up
+        jobs already queued (by seeding, or left over from before a restart).
+        Cheap once they're running.
+        """
+
+        if not self._threads:
+            self.wake()
+
+    def wake(self):
+        """Start the workers if needed and tell them there is work to do.
+
+        Does nothing when testing, so tests run jobs explicitly.
+        """
+
+        if self.app.testing or not self.size:
+            return
+
+        with self._lock:
+            if not self._threads:
+                for i in range(self.size):
+                    thread = threading.Thread(target=self._work,
+                        name=f"map-worker-{i}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+        self._wakeup.set()
+
+    def _work(self):
+        """Run jobs until there are none due, then sleep until woken."""
+
+        with self.app.app_context():
+            while True:
+                try:
+                    ran = run_next_job()
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception("map job failed")
+                    ran = False
+
+                if not ran:
+                    self._wakeup.wait(POLL_SECONDS)
+                    self._wakeup.clear()
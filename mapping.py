@@ -1,41 +1,352 @@
+import hashlib
+import json
 import os
+import tempfile
+import threading
+import time
 from dotenv import load_dotenv
 
 import requests
+from requests.adapters import HTTPAdapter
 
 load_dotenv()
 
 API_KEY = os.environ.get("MAPQUEST_API_KEY")
 BASE_URL = os.environ.get("BASE_URL")
+GEOCODE_URL = os.environ.get("GEOCODE_URL",
+    "https://www.mapquestapi.com/geocoding/v1/address")
 
-def get_map_url(address, city, state):
+# maps are stored by content address (a hash of everything that goes into
+# the MapQuest request), so the same location is only ever downloaded once
+MAPS_DIR = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)), "static", "images", "maps")
+MAPS_URL = "/static/images/maps"
+
+CHUNK_SIZE = 64 * 1024
+
+MAP_SIZE = "250,200@2x"
+MAP_ZOOM = 15
+
+# (connect, read) timeouts in seconds for MapQuest requests
+MAP_TIMEOUT = (
+    float(os.environ.get("MAP_CONNECT_TIMEOUT", 3.05)),
+    float(os.environ.get("MAP_READ_TIMEOUT", 10)),
+)
+
+_stats_lock = threading.Lock()
+map_stats = {"hits": 0, "misses": 0, "errors": 0, "not_modified": 0}
+
+
+def _count(stat):
+    """Increment a map store counter."""
+
+    with _stats_lock:
+        map_stats[stat] += 1
+
+
+class MapDownloadError(Exception):
+    """Raised when MapQuest won't give us a map."""
+
+    def __init__(self, status_code):
+        super().__init__(f"map download failed: HTTP {status_code}")
+        self.status_code = status_code
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling MapQuest while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Fails fast once MapQuest has failed too many times in a row.
+
+    After reset_timeout seconds one trial call is let through: if it
+    succeeds the breaker closes again, otherwise it stays open.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """Return 'closed', 'open' or 'half-open'."""
+
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may be made now."""
+
+        with self._lock:
+            state = self.state
+
+            if state == 'open' or (state == 'half-open' and self.trial_running):
+                raise CircuitOpenError("MapQuest circuit breaker is open")
+
+            if state == 'half-open':
+                self.trial_running = True
+
+    def record_success(self):
+        """Close the breaker after a successful call."""
+
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        """Count a failed call, opening the breaker if there were too many."""
+
+        with self._lock:
+            self.failures += 1
+            self.trial_running = False
+
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class MapClient:
+    """HTTP client for MapQuest, with pooled connections, timeouts and a
+    circuit breaker."""
+
+    def __init__(self, pool_size=10, timeout=MAP_TIMEOUT, breaker=None):
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+
+        # reuse connections (and TLS sessions) across requests and threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "failures": 0,
+            "rejected": 0,
+            "total_seconds": 0.0,
+            "max_seconds": 0.0,
+        }
+
+    def get(self, url, **kwargs):
+        """GET url, raising CircuitOpenError if MapQuest is failing.
+
+        Server errors and network errors count against the breaker.
+        """
+
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            self._record(rejected=True)
+            raise
+
+        start = time.monotonic()
+
+        try:
+            resp = self.session.get(url, timeout=self.timeout, **kwargs)
+        except requests.RequestException:
+            self.breaker.record_failure()
+            self._record(time.monotonic() - start, failed=True)
+            raise
+
+        if resp.status_code >= 500:
+            self.breaker.record_failure()
+            self._record(time.monotonic() - start, failed=True)
+        else:
+            self.breaker.record_success()
+            self._record(time.monotonic() - start)
+
+        return resp
+
+    def _record(self, seconds=0.0, failed=False, rejected=False):
+        """Update request counters."""
+
+        with self._lock:
+            if rejected:
+                self.stats["rejected"] += 1
+                return
+
+            self.stats["requests"] += 1
+            self.stats["failures"] += failed
+            self.stats["total_seconds"] += seconds
+            self.stats["max_seconds"] = max(self.stats["max_seconds"], seconds)
+
+    def get_stats(self):
+        """Return a copy of the request counters, with the breaker state."""
+
+        with self._lock:
+            stats = dict(self.stats)
+
+        requests_made = stats["requests"]
+        stats["avg_seconds"] = (stats["total_seconds"] / requests_made
+            if requests_made else None)
+        stats["breaker"] = self.breaker.state
+        return stats
+
+
+client = MapClient()
+
+
+def get_map_url(address, city, state, size=MAP_SIZE, zoom=MAP_ZOOM):
     """Get MapQuest URL for a static map for this location."""
 
     base = f"{BASE_URL}?key={API_KEY}"
     where = f"{address},{city},{state}"
-    return f"{base}&center={where}&defaultMarker=marker-red-sm&size=250,200@2x&zoom=15&locations={where}"
+    return f"{base}&center={where}&defaultMarker=marker-red-sm&size={size}&zoom={zoom}&locations={where}"
+
+
+def get_map_key(address, city, state, size=MAP_SIZE, zoom=MAP_ZOOM):
+    """Return the content address of the map for this location.
+
+    Case and extra whitespace are ignored, so "3966 24th st" and
+    "3966  24th St" share a map.
+    """
+
+    parts = [" ".join(str(part).split()).lower()
+        for part in (address, city, state, size, zoom)]
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+
+def get_map_path(key, maps_dir=None):
+    """Return the file path where the map with this key is stored."""
+
+    return os.path.join(maps_dir or MAPS_DIR, f"{key}.jpg")
+
+
+def lookup_map(address, city, state, maps_dir=None):
+    """Return the static URL of the stored map for this location, or None
+    if it hasn't been downloaded yet."""
+
+    key = get_map_key(address, city, state)
+
+    if os.path.exists(get_map_path(key, maps_dir)):
+        _count("hits")
+        return f"{MAPS_URL}/{key}.jpg"
+
+    _count("misses")
+    return None
+
+
+def get_meta_path(key, maps_dir=None):
+    """Return the file path of the validators (ETag etc.) for a stored map."""
+
+    return os.path.join(maps_dir or MAPS_DIR, f"{key}.json")
+
+
+def read_map_meta(key, maps_dir=None):
+    """Return dict of validators stored for this map, or {} if none."""
 
+    try:
+        with open(get_meta_path(key, maps_dir)) as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return {}
 
-def save_map(id, address, city, state):
-    """Get static map and save in static/maps directory of this app."""
 
-    path = os.path.abspath(os.path.dirname(__file__))
-    file_name = f"{id}.jpg"
+def write_map(path, chunks):
+    """Write chunks of bytes to path atomically, so readers never see a
+    partial file."""
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            for chunk in chunks:
+                fp.write(chunk)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def save_map(address, city, state, maps_dir=None, force=False):
+    """Get static map for this location, downloading it into the map store
+    only if we don't have it already.
+
+    If force is true, a stored map is revalidated with MapQuest using its
+    ETag/Last-Modified, and only downloaded again if it has changed.
+
+    Returns the static URL of the map. Raises MapDownloadError if MapQuest
+    refuses the request.
+    """
+
+    if not force:
+        url = lookup_map(address, city, state, maps_dir)
+        if url:
+            return url
+
+    key = get_map_key(address, city, state)
+    path = get_map_path(key, maps_dir)
+    url = f"{MAPS_URL}/{key}.jpg"
+
+    headers = {}
+    if os.path.exists(path):
+        meta = read_map_meta(key, maps_dir)
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
 
-    # get URL for map, download it, and save it with a path
-    # like "PATH/static/maps/1.jpg"
     map_url = get_map_url(address, city, state)
-    resp = requests.get(map_url, stream=True)
+    resp = client.get(map_url, stream=True, headers=headers)
+
+    try:
+        if resp.status_code == 304:
+            _count("not_modified")
+            return url
+
+        if not resp.ok:
+            _count("errors")
+            raise MapDownloadError(resp.status_code)
+
+        write_map(path, resp.iter_content(CHUNK_SIZE))
+
+    finally:
+        resp.close()
+
+    meta = {
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+    }
+    write_map(get_meta_path(key, maps_dir), [json.dumps(meta).encode()])
+
+    return url
+
+
+def geocode(address, city, state):
+    """Return (latitude, longitude) for this location, or None if MapQuest
+    couldn't find it."""
+
+    resp = client.get(GEOCODE_URL, params={
+        "key": API_KEY,
+        "location": f"{address},{city},{state}",
+        "maxResults": 1,
+    })
+
+    if not resp.ok:
+        return None
+
+    try:
+        lat_lng = resp.json()["results"][0]["locations"][0]["latLng"]
+        return float(lat_lng["lat"]), float(lat_lng["lng"])
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
 
-    if resp.ok:
-        with open(os.path.join(path+"/static/images/maps/", file_name), 'wb') as fp:
-            fp.write(resp.content)
-        print("Download finished")
-    else:
-        print("Download not allowed")
+def get_map_stats():
+    """Return a copy of the map store counters, with the hit rate."""
 
-    return resp.url
+    with _stats_lock:
+        stats = dict(map_stats)
 
-# this works too
-#import urllib.request
-#urllib.request.urlretrieve(url, filename)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else None
+    return stats
@@ -1,17 +1,25 @@
 """Data models for Flask Cafe"""
 
 
-from flask_bcrypt import Bcrypt, generate_password_hash, check_password_hash
+from datetime import datetime
+
 from flask_sqlalchemy import SQLAlchemy
-from mapping import save_map
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from mapping import save_map, lookup_map, geocode
+from indexes import record_change
+from passwords import hasher
 
 
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 DEFAULT_IMG_URL = "/static/images/default-cafe.jpg"
 DEFAULT_PROFILE_URL = "/static/images/default-pic.png"
 
+# text search configuration for cafe search vectors & queries (PostgreSQL)
+SEARCH_CONFIG = "english"
+
 class City(db.Model):
     """Cities for cafes."""
 
@@ -32,6 +40,20 @@ class City(db.Model):
         nullable=False,
     )
 
+    # bumped on every change; see bump_version
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+    )
+
     @classmethod
     def get_choices(self):
         """ returns list of tuples containing city code & name """
@@ -82,8 +104,52 @@ class Cafe(db.Model):
         default=DEFAULT_IMG_URL,
     )
 
+    # bumped on every change; see bump_version
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+    )
+
+    # number of likes, kept in step by Like.add & Like.remove; `flask likes
+    # reconcile` fixes any drift
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # set by the background map job; None until the cafe is geocoded
+    latitude = db.Column(db.Float)
+
+    longitude = db.Column(db.Float)
+
+    # weighted words of name, description & address, for full-text search
+    # on PostgreSQL; see set_search_vector. Deferred, as only search needs it
+    search_vector = db.deferred(db.Column(
+        TSVECTOR().with_variant(db.Text, 'sqlite'),
+    ))
+
     city = db.relationship("City", backref='cafes')
 
+    # cafes are listed in (name, id) order, a page at a time, and may be
+    # filtered by city
+    __table_args__ = (
+        db.Index('ix_cafes_name_id', 'name', 'id'),
+        db.Index('ix_cafes_city_code_name_id', 'city_code', 'name', 'id'),
+        db.Index('ix_cafes_search_vector', 'search_vector',
+            postgresql_using='gin'),
+        db.Index('ix_cafes_like_count_id', 'like_count', 'id'),
+    )
+
     def __repr__(self):
         return f'<Cafe id={self.id} name="{self.name}">'
 
@@ -94,8 +160,42 @@ class Cafe(db.Model):
         return f'{city.name}, {city.state}'
 
     def save_map(self):
+        """Return static URL of map for cafe, downloading it on a miss."""
+
+        return save_map(self.address, self.city_code, self.city.state)
+
+    def get_map(self):
+        """Return static URL of map for cafe, or None if not downloaded yet."""
+
+        return lookup_map(self.address, self.city_code, self.city.state)
+
+    def geocode(self):
+        """Look up and set cafe's latitude & longitude.
+
+        Returns True if the location was found."""
+
+        location = geocode(self.address, self.city.name, self.city.state)
+
+        if location:
+            self.latitude, self.longitude = location
 
-        return save_map(self.id, self.address, self.city_code, self.city.state)
+        return location is not None
+
+    def location_changed(self):
+        """Return True if address or city has changed since last commit."""
+
+        attrs = db.inspect(self).attrs
+        return (attrs.address.history.has_changes()
+            or attrs.city_code.history.has_changes())
+
+    def search_text_changed(self):
+        """Return True if name, description or address has changed since
+        last commit."""
+
+        attrs = db.inspect(self).attrs
+        return (attrs.name.history.has_changes()
+            or attrs.description.history.has_changes()
+            or attrs.address.history.has_changes())
 
 
 
@@ -136,6 +236,10 @@ class User(db.Model):
     hashed_password = db.Column(db.Text,
         nullable=False)
 
+    # bumped whenever user likes or unlikes a cafe
+    likes_version = db.Column(db.Integer,
+        nullable=False, default=0)
+
     liked_cafes = db.relationship('Cafe',
         secondary='likes',
         backref='liking_users'
@@ -149,24 +253,48 @@ class User(db.Model):
     @classmethod
     def authenticate(cls, username, password):
         """ validates that password entered is equivalent to the hashed password
-        in the database """
+        in the database; rehashes it if it was made at an outdated cost """
 
         user = User.query.filter_by(username=username).first() or None
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.hashed_password, password)
-            if is_auth:
-                return user
+        if not user:
+            # checks the password anyway, so unknown usernames take as long
+            # as wrong passwords
+            hasher.verify_dummy(password)
+            return False
+
+        is_auth = hasher.verify(user.hashed_password, password)
+        if is_auth:
+            if hasher.needs_rehash(user.hashed_password):
+                user.hashed_password = hasher.hash(password)
+            return user
 
         return False
 
+    @classmethod
+    def get_taken(cls, username=None, email=None):
+        """ returns dict of whether each given username/email is taken by a
+        user, checked with (unique-indexed) EXISTS queries in one round trip """
+
+        checks = {name: db.select(User.id).where(column == value).exists()
+            for name, column, value in (("username", User.username, username),
+                ("email", User.email, email))
+            if value is not None}
+
+        if not checks:
+            return {}
+
+        row = db.session.execute(db.select(*(
+            check.label(name) for name, check in checks.items()))).one()
+        return row._asdict()
+
     @classmethod
     def register(cls, username, email, first_name, last_name, description,
     password, admin=False, image_url=DEFAULT_PROFILE_URL):
         """ handles password hashiing and returns new user """
 
         #look into admin stuff from flask wrap up
-        hashed_pw = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pw = hasher.hash(password)
 
         user = User(
             username = username,
@@ -200,6 +328,216 @@ class Like(db.Model):
         primary_key=True,
     )
 
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # for counting a cafe's likes; the primary key only helps by user
+    __table_args__ = (
+        db.Index('ix_likes_cafe_id', 'cafe_id'),
+    )
+
+    @classmethod
+    def add(cls, user_id, cafe_id):
+        """ likes cafe for user, doing nothing if they already like it;
+        returns True if a like was added
+
+        Raises IntegrityError if there's no such cafe. """
+
+        created_at = db.session.scalar(upsert(cls)
+            .values(user_id=user_id, cafe_id=cafe_id)
+            .on_conflict_do_nothing()
+            .returning(cls.created_at))
+
+        if created_at is None:
+            return False
+
+        cls.update_count(cafe_id, 1)
+        # not flushed, so tell in-memory indexes (like trending) ourselves
+        record_change(db.session, "insert",
+            cls(user_id=user_id, cafe_id=cafe_id, created_at=created_at))
+        return True
+
+    @classmethod
+    def remove(cls, user_id, cafe_id):
+        """ unlikes cafe for user; returns True if they had liked it """
+
+        # indexes are told of the unlike below, rather than reset
+        created_at = db.session.scalar(db.delete(cls)
+            .where(cls.user_id == user_id, cls.cafe_id == cafe_id)
+            .returning(cls.created_at)
+            .execution_options(skip_index_reset=True))
+
+        if created_at is None:
+            return False
+
+        cls.update_count(cafe_id, -1)
+        record_change(db.session, "delete",
+            cls(user_id=user_id, cafe_id=cafe_id, created_at=created_at))
+        return True
+
+    @staticmethod
+    def update_count(cafe_id, change):
+        """ adds change to cafe's like count, in the same transaction as the
+        like itself
+
+        Leaves the cafe's version & updated_at alone, so cached cafe cards
+        are kept, and in-memory indexes, which don't use the count, aren't
+        reset. """
+
+        db.session.execute(db.update(Cafe)
+            .where(Cafe.id == cafe_id)
+            .values(like_count=Cafe.like_count + change,
+                updated_at=Cafe.updated_at)
+            .execution_options(skip_index_reset=True))
+
+    @classmethod
+    def count_for(cls, cafe_id):
+        """ returns number of likes of cafe, or None if there's no such
+        cafe """
+
+        return db.session.scalar(
+            db.select(Cafe.like_count).where(Cafe.id == cafe_id))
+
+class CafeNeighbor(db.Model):
+    """ Cafes liked by the same people as a cafe; see recommendations """
+
+    __tablename__ = 'cafe_neighbors'
+
+    cafe_id = db.Column(
+        db.Integer,
+        db.ForeignKey('cafes.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    neighbor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('cafes.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # cosine similarity of the two cafes' likers
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    # number of users who like both
+    co_likes = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+class MapJob(db.Model):
+    """ Queued map downloads for cafes """
+
+    __tablename__ = 'map_jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=True,
+    )
+
+    cafe_id = db.Column(
+        db.Integer,
+        db.ForeignKey('cafes.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    # pending -> done, or failed after too many attempts
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+        default='pending',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # when a pending job may next be claimed; pushed forward while a worker
+    # holds the job so that a crashed worker's job gets retried
+    run_after = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    last_error = db.Column(db.Text)
+
+    cafe = db.relationship('Cafe')
+
+    __table_args__ = (
+        db.Index('ix_map_jobs_status_run_after', 'status', 'run_after'),
+    )
+
+    @classmethod
+    def enqueue(cls, cafe):
+        """ adds a pending map job for cafe, unless one is already queued """
+
+        job = None
+        if cafe.id:
+            job = cls.query.filter_by(cafe_id=cafe.id, status='pending').first()
+
+        if not job:
+            job = MapJob(cafe=cafe)
+            db.session.add(job)
+
+        return job
+
+
+def upsert(model):
+    """ returns INSERT statement for model supporting ON CONFLICT, for the
+    session's database """
+
+    insert = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}[
+        db.session.get_bind().dialect.name]
+    return insert(model)
+
+
+@event.listens_for(City, 'before_update')
+@event.listens_for(Cafe, 'before_update')
+def bump_version(mapper, connection, target):
+    """ bumps version of a changed city or cafe, so anything cached under
+    the old version (like rendered cafe cards) is no longer used """
+
+    if db.object_session(target).is_modified(target, include_collections=False):
+        target.version += 1
+
+
+def make_search_vector(name, description, address):
+    """ returns SQL expression for the search vector of a cafe (PostgreSQL
+    only); takes values or columns """
+
+    def weighted(text, weight):
+        return db.func.setweight(
+            db.func.to_tsvector(SEARCH_CONFIG, db.func.coalesce(text, '')),
+            weight)
+
+    return (weighted(name, 'A')
+        .op('||')(weighted(description, 'B'))
+        .op('||')(weighted(address, 'C')))
+
+
+@event.listens_for(Cafe, 'before_insert')
+@event.listens_for(Cafe, 'before_update')
+def set_search_vector(mapper, connection, target):
+    """ recomputes a new or changed cafe's search vector in the database,
+    weighting name over description over address """
+
+    if connection.dialect.name != 'postgresql':
+        return
+
+    if target.search_text_changed():
+        target.search_vector = make_search_vector(
+            target.name, target.description, target.address)
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -209,3 +547,4 @@ def connect_db(app):
     app.app_context().push()
     db.app = app
     db.init_app(app)
+    hasher.init_app(app)
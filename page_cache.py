@@ -0,0 +1,162 @@
+"""Full-page cache for anonymous visitors to Flask Cafe.
+
+Logged out visitors all see the same HTML for the homepage and cafe pages,
+so for a few seconds at a time it is served from a cache, before loading
+the user, making a CSRF form, querying the database or rendering.
+
+When a cached page expires, one request (per cache backend) regenerates
+it while others keep getting the expired copy; if there's no copy at all
+they wait briefly for the one being made.
+"""
+
+import time
+
+from flask import g, request, session, Response
+
+PAGE_CACHE_HEADER = 'X-Page-Cache'
+
+# headers worth keeping with a cached page; never Set-Cookie
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control',
+    'Vary')
+
+
+class PageCache:
+    """Caches whole responses to anonymous GETs of some endpoints.
+
+    backend needs get/set/add/delete, like cache.LRUCache. The cache is off
+    unless the app's PAGE_CACHE_TTL config is a positive number of seconds.
+    """
+
+    # how long an expired page may still be served while it's regenerated
+    stale_seconds = 60
+
+    # how long a request waits for a page someone else is generating
+    wait_seconds = 2.0
+    poll_seconds = 0.05
+
+    def __init__(self, backend, endpoints, user_key):
+        self.backend = backend
+        self.endpoints = set(endpoints)
+        self.user_key = user_key
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "waits": 0}
+
+    def init_app(self, app):
+        """Register the cache's hooks on app.
+
+        Call this before registering other before_request functions, so a
+        cached page skips them.
+        """
+
+        self.app = app
+        app.before_request(self.serve_cached_page)
+        app.after_request(self.cache_page)
+        app.teardown_request(self.release_lock)
+
+    def get_ttl(self):
+        """Return how many seconds pages are cached for (0 if off)."""
+
+        return self.app.config.get('PAGE_CACHE_TTL', 0)
+
+    def is_cacheable(self):
+        """Return True if this request may be answered from the cache."""
+
+        return (self.get_ttl() > 0
+            and request.method == 'GET'
+            and request.endpoint in self.endpoints
+            and self.user_key not in session
+            and '_flashes' not in session)
+
+    def serve_cached_page(self):
+        """Return the cached page for this request, if there is one to use.
+
+        Otherwise note that the page should be cached once it's made.
+        """
+
+        if not self.is_cacheable():
+            return None
+
+        key = f"page:{request.full_path}"
+        lock_key = f"{key}:lock"
+        entry = self.backend.get(key)
+
+        if entry and entry["expires"] > time.time():
+            self.stats["hits"] += 1
+            return self.make_response(entry, 'hit')
+
+        if self.backend.add(lock_key, True, ttl=self.wait_seconds * 5):
+            g.page_cache_lock = lock_key
+
+        elif entry:
+            # someone else is making this page
+            self.stats["stale"] += 1
+            return self.make_response(entry, 'stale')
+
+        else:
+            entry = self.wait_for(key)
+            if entry:
+                self.stats["waits"] += 1
+                return self.make_response(entry, 'hit')
+
+        self.stats["misses"] += 1
+        g.page_cache_key = key
+        return None
+
+    def wait_for(self, key):
+        """Wait a little while for another request to cache key."""
+
+        deadline = time.monotonic() + self.wait_seconds
+
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_seconds)
+            entry = self.backend.get(key)
+            if entry:
+                return entry
+
+        return None
+
+    def cache_page(self, response):
+        """Cache the response, if serve_cached_page asked for it."""
+
+        key = g.pop('page_cache_key', None)
+
+        if (key and response.status_code == 200
+                and not response.direct_passthrough):
+            ttl = self.get_ttl()
+            entry = {
+                "expires": time.time() + ttl,
+                "status": response.status_code,
+                "headers": [(name, response.headers[name])
+                    for name in CACHED_HEADERS if name in response.headers],
+                "body": response.get_data(),
+            }
+            self.backend.set(key, entry, ttl=ttl + self.stale_seconds)
+
+        if key:
+            response.headers[PAGE_CACHE_HEADER] = 'miss'
+
+        return response
+
+    def release_lock(self, exc):
+        """Let other requests regenerate the page again."""
+
+        lock_key = g.pop('page_cache_lock', None)
+        if lock_key:
+            self.backend.delete(lock_key)
+
+    def make_response(self, entry, state):
+        """Return a response for a cached entry (a 304 if the client's copy
+        is current)."""
+
+        response = Response(entry["body"], status=entry["status"],
+            headers=entry["headers"])
+        response.headers[PAGE_CACHE_HEADER] = state
+        return response.make_conditional(request)
+
+    def get_stats(self):
+        """Return dict of hit/miss counts and hit rate."""
+
+        stats = dict(self.stats)
+        lookups = sum(stats.values())
+        served = stats["hits"] + stats["stale"] + stats["waits"]
+        stats["hit_rate"] = served / lookups if lookups else None
+        return stats
@@ -0,0 +1,101 @@
+"""Keyset (cursor) pagination for Flask Cafe.
+
+Pages are found with WHERE (sort columns) > (last row seen) rather than
+OFFSET, so every page costs the same however deep it is. Cursors are the
+sort values of the first/last row on a page, encoded for use in URLs.
+"""
+
+import base64
+import json
+from dataclasses import dataclass
+
+from sqlalchemy import tuple_
+
+from models import db
+
+
+class BadCursor(ValueError):
+    """Raised for a cursor that can't be decoded."""
+
+
+def encode_cursor(values):
+    """Return URL-safe cursor for a row's sort values."""
+
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, types):
+    """Return the list of sort values in cursor, or raise BadCursor unless
+    there's one of each Python type in types (e.g. (str, int)), in order."""
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except ValueError as exc:
+        raise BadCursor(cursor) from exc
+
+    # exact types, so true/false don't pass as ints, and never null
+    if (not isinstance(values, list) or len(values) != len(types)
+            or any(type(value) is not expected
+                for value, expected in zip(values, types))):
+        raise BadCursor(cursor)
+
+    return values
+
+
+def get_cursor_types(columns):
+    """Return the Python type of each sort column, for decode_cursor."""
+
+    return [column.type.python_type for column in columns]
+
+
+@dataclass
+class Page:
+    """One page of results, with cursors for the pages either side."""
+
+    items: list
+    next: str = None
+    prev: str = None
+
+
+def paginate(query, columns, after=None, before=None, per_page=24,
+        scalars=True):
+    """Return a Page of query's results, ordered by columns.
+
+    columns must uniquely order rows (e.g. end with the primary key) and
+    should be indexed together. after/before are cursors from a previous
+    Page. Use scalars=False for queries of columns rather than entities.
+    """
+
+    key = tuple_(*columns)
+    types = get_cursor_types(columns)
+
+    if before:
+        values = decode_cursor(before, types)
+        query = (query.where(key < tuple_(*values))
+            .order_by(*[column.desc() for column in columns]))
+    else:
+        query = query.order_by(*columns)
+        if after:
+            values = decode_cursor(after, types)
+            query = query.where(key > tuple_(*values))
+
+    result = db.session.execute(query.limit(per_page + 1))
+    rows = result.scalars().all() if scalars else result.all()
+
+    more = len(rows) > per_page
+    items = rows[:per_page]
+
+    def cursor(item):
+        return encode_cursor([getattr(item, column.key) for column in columns])
+
+    if before:
+        items.reverse()
+        return Page(items,
+            next=cursor(items[-1]) if items else None,
+            prev=cursor(items[0]) if more else None)
+
+    return Page(items,
+        next=cursor(items[-1]) if more else None,
+        prev=cursor(items[0]) if after and items else None)
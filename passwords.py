@@ -0,0 +1,123 @@
+"""Password hashing for Flask Cafe.
+
+bcrypt is slow on purpose, so hashes are made and checked on a small,
+bounded pool of threads, which caps how many bcrypt computations run at
+once in this process (bcrypt releases the GIL, so they'd otherwise all
+compete for the CPU). The request thread still waits for its result, queue
+time included, and each process has its own pool, so this doesn't free up
+request threads or limit hashing across processes.
+
+The cost factor comes from the BCRYPT_LOG_ROUNDS config; a stored hash made
+with a different cost is rehashed the next time its user logs in.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+
+class PasswordHasher:
+    """Hashes and checks passwords with bcrypt on a pool of threads."""
+
+    def __init__(self, bcrypt, max_workers=DEFAULT_WORKERS):
+        self.bcrypt = bcrypt
+        self.max_workers = max_workers
+        self._pool = None
+        self._dummy_hash = None
+        self._lock = threading.Lock()
+        self.stats = {op: {"count": 0, "total_ms": 0.0, "max_ms": 0.0,
+            "wait_ms": 0.0} for op in ("hash", "verify")}
+
+    def init_app(self, app):
+        """Set the cost factor (BCRYPT_LOG_ROUNDS) and pool size
+        (BCRYPT_WORKERS) from app's config."""
+
+        self.bcrypt.init_app(app)
+        self.max_workers = app.config.get('BCRYPT_WORKERS', self.max_workers)
+
+    def _run(self, op, fn, *args):
+        """Run fn(*args) on the pool, timing it, and return its result."""
+
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.max_workers,
+                    thread_name_prefix="bcrypt")
+
+        queued = time.perf_counter()
+
+        def timed():
+            start = time.perf_counter()
+            result = fn(*args)
+            return result, start, time.perf_counter()
+
+        result, start, end = self._pool.submit(timed).result()
+        self._record(op, (end - start) * 1000, (start - queued) * 1000)
+        return result
+
+    def _record(self, op, ms, wait_ms):
+        """Update timing counters for op."""
+
+        with self._lock:
+            stats = self.stats[op]
+            stats["count"] += 1
+            stats["total_ms"] += ms
+            stats["max_ms"] = max(stats["max_ms"], ms)
+            stats["wait_ms"] += wait_ms
+
+    def hash(self, password):
+        """Return bcrypt hash of password, at the configured cost."""
+
+        return self._run("hash",
+            self.bcrypt.generate_password_hash, password).decode('UTF-8')
+
+    def verify(self, hashed, password):
+        """Return True if password matches hashed."""
+
+        return self._run("verify",
+            self.bcrypt.check_password_hash, hashed, password)
+
+    def verify_dummy(self, password):
+        """Check password against a throwaway hash at the configured cost,
+        taking as long as verify would; returns False."""
+
+        # made once (and again if the cost changes), outside the stats
+        if self._dummy_hash is None or self.needs_rehash(self._dummy_hash):
+            self._dummy_hash = self.bcrypt.generate_password_hash(
+                os.urandom(16).hex()).decode('UTF-8')
+
+        self.verify(self._dummy_hash, password)
+        return False
+
+    def needs_rehash(self, hashed):
+        """Return True if hashed was made at a different cost than the
+        configured one."""
+
+        # bcrypt hashes look like $2b$12$..., with the cost third
+        try:
+            return int(hashed.split('$')[2]) != self.bcrypt._log_rounds
+        except (IndexError, ValueError):
+            return True
+
+    def get_stats(self):
+        """Return timing counters for hashing & verifying, with averages."""
+
+        with self._lock:
+            stats = {op: dict(counts) for op, counts in self.stats.items()}
+
+        for counts in stats.values():
+            count = counts["count"]
+            counts["avg_ms"] = counts["total_ms"] / count if count else None
+            counts["avg_wait_ms"] = counts["wait_ms"] / count if count else None
+
+        stats["log_rounds"] = self.bcrypt._log_rounds
+        return stats
+
+
+hasher = PasswordHasher(bcrypt)
@@ -0,0 +1,66 @@
+"""Count SQL queries and database time for each request."""
+
+import time
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+QUERY_COUNT_HEADER = 'X-Query-Count'
+DB_TIME_HEADER = 'X-DB-Time-Ms'
+
+
+class QueryStats:
+    """Number of queries made and seconds spent running them."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+def get_query_stats():
+    """Return QueryStats for the current request, or None outside one."""
+
+    if has_app_context():
+        return g.get('query_stats')
+    return None
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['query_start'].pop()
+
+    stats = get_query_stats()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += seconds
+
+
+def init_query_stats(app):
+    """Count queries for every request to app, reporting them in response
+    headers and the log.
+
+    Call this before registering other before_request functions, so their
+    queries are counted too.
+    """
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = get_query_stats()
+
+        if stats is not None:
+            response.headers[QUERY_COUNT_HEADER] = str(stats.count)
+            response.headers[DB_TIME_HEADER] = f"{stats.seconds * 1000:.2f}"
+            app.logger.info("%s %s: %d queries in %.2fms", request.method,
+                request.path, stats.count, stats.seconds * 1000)
+
+        return response
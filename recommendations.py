@@ -0,0 +1,179 @@
+"""Cafe recommendations: "people who liked this also liked".
+
+Two cafes are similar when the same people like both. build_neighbors
+counts, for every pair of cafes, how many users like both (a sparse
+cafe x cafe co-occurrence matrix, made from the users x cafes likes matrix
+M as M.T @ M), scores each pair by the cosine similarity of their likers,
+and keeps each cafe's top NEIGHBORS_PER_CAFE in the cafe_neighbors table,
+so a cafe's recommendations are one indexed lookup.
+
+`flask recs build` rebuilds the table. In between, each like or unlike
+updates the pairs it changes (see update_neighbors); scores of other pairs
+involving the same cafes drift a little until the next build.
+"""
+
+import math
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import tuple_
+from sqlalchemy.orm import aliased
+
+from models import db, Cafe, CafeNeighbor, Like, upsert
+
+NEIGHBORS_PER_CAFE = 10
+
+# how many of a user's other likes (most recent first) a like is paired with
+# as it happens; older pairs are picked up by the next build
+MAX_PAIRED_LIKES = 100
+
+
+def build_neighbors(user_ids, cafe_ids, k=NEIGHBORS_PER_CAFE):
+    """Return [(cafe id, neighbor id, score, co_likes)] of every cafe's top
+    k neighbors, from arrays of the user & cafe of each like."""
+
+    users, user_index = np.unique(user_ids, return_inverse=True)
+    cafes, cafe_index = np.unique(cafe_ids, return_inverse=True)
+
+    likes = sparse.csr_matrix(
+        (np.ones(len(cafe_index), dtype=np.int32), (user_index, cafe_index)),
+        shape=(len(users), len(cafes)))
+
+    co_likes = (likes.T @ likes).tocsr()
+    co_likes.setdiag(0)
+    co_likes.eliminate_zeros()
+
+    counts = np.asarray(likes.sum(axis=0)).ravel()
+
+    rows = []
+
+    for i in range(len(cafes)):
+        start, end = co_likes.indptr[i], co_likes.indptr[i + 1]
+        neighbors = co_likes.indices[start:end]
+        shared = co_likes.data[start:end]
+        scores = shared / np.sqrt(counts[i] * counts[neighbors])
+
+        top = np.arange(len(scores))
+        if len(top) > k:
+            top = np.argpartition(-scores, k)[:k]
+        # best first, then by id so ties come out the same every build
+        top = top[np.lexsort((cafes[neighbors[top]], -scores[top]))]
+
+        rows.extend((int(cafes[i]), int(cafes[neighbors[j]]), float(scores[j]),
+            int(shared[j])) for j in top)
+
+    return rows
+
+
+def rebuild_neighbors(k=NEIGHBORS_PER_CAFE):
+    """Replace every cafe's stored neighbors with ones built from all likes.
+
+    Returns the number of neighbors stored. Doesn't commit.
+    """
+
+    likes = np.array(
+        db.session.execute(db.select(Like.user_id, Like.cafe_id)).all(),
+        dtype=np.int64).reshape(-1, 2)
+
+    rows = build_neighbors(likes[:, 0], likes[:, 1], k)
+
+    db.session.execute(db.delete(CafeNeighbor))
+    if rows:
+        db.session.execute(db.insert(CafeNeighbor), [
+            dict(cafe_id=cafe_id, neighbor_id=neighbor_id, score=score,
+                co_likes=co_likes)
+            for cafe_id, neighbor_id, score, co_likes in rows])
+
+    return len(rows)
+
+
+def update_neighbors(user_id, cafe_id, k=NEIGHBORS_PER_CAFE):
+    """Update stored neighbors after user likes or unlikes cafe, which
+    changes how many users like it together with each of their other liked
+    cafes. Call after Like.add/Like.remove; doesn't commit."""
+
+    paired = db.session.scalars(db.select(Like.cafe_id)
+        .where(Like.user_id == user_id, Like.cafe_id != cafe_id)
+        .order_by(Like.created_at.desc())
+        .limit(MAX_PAIRED_LIKES)).all()
+
+    if not paired:
+        return
+
+    # users who like both cafe and each paired cafe
+    other = aliased(Like)
+    co_likes = dict(db.session.execute(
+        db.select(other.cafe_id, db.func.count())
+        .select_from(Like)
+        .join(other, other.user_id == Like.user_id)
+        .where(Like.cafe_id == cafe_id, other.cafe_id.in_(paired))
+        .group_by(other.cafe_id)).all())
+
+    counts = dict(db.session.execute(db.select(Cafe.id, Cafe.like_count)
+        .where(Cafe.id.in_([cafe_id, *paired]))).all())
+
+    pairs = {}
+    for paired_id in paired:
+        shared = co_likes.get(paired_id, 0)
+        # like_count can drift (e.g. likes added through User.liked_cafes),
+        # but each cafe has at least the likes it shares, so that's a floor
+        score = (shared / math.sqrt(max(counts.get(cafe_id, 0), shared)
+                * max(counts.get(paired_id, 0), shared))
+            if shared else 0)
+        pairs[paired_id] = (score, shared)
+
+    stored = {}
+    for row in db.session.scalars(db.select(CafeNeighbor)
+            .where(CafeNeighbor.cafe_id.in_([cafe_id, *paired]))):
+        stored.setdefault(row.cafe_id, {})[row.neighbor_id] = (
+            row.score, row.co_likes)
+
+    removed = []
+    changed = []
+
+    def merge(id, updates):
+        current = stored.get(id, {})
+        neighbors = {**current, **updates}
+        top = sorted(((neighbor_id, value)
+                for neighbor_id, value in neighbors.items() if value[1]),
+            key=lambda item: (-item[1][0], item[0]))[:k]
+
+        kept = dict(top)
+        removed.extend((id, neighbor_id) for neighbor_id in current
+            if neighbor_id not in kept)
+        changed.extend((id, neighbor_id, score, shared)
+            for neighbor_id, (score, shared) in top
+            if current.get(neighbor_id) != (score, shared))
+
+    merge(cafe_id, pairs)
+    for paired_id, value in pairs.items():
+        merge(paired_id, {cafe_id: value})
+
+    if removed:
+        db.session.execute(db.delete(CafeNeighbor).where(
+            tuple_(CafeNeighbor.cafe_id, CafeNeighbor.neighbor_id)
+            .in_(removed)))
+
+    if changed:
+        insert = upsert(CafeNeighbor)
+        db.session.execute(
+            insert.on_conflict_do_update(
+                index_elements=[CafeNeighbor.cafe_id, CafeNeighbor.neighbor_id],
+                set_={"score": insert.excluded.score,
+                    "co_likes": insert.excluded.co_likes}),
+            [dict(cafe_id=id, neighbor_id=neighbor_id, score=score,
+                co_likes=shared)
+                for id, neighbor_id, score, shared in changed])
+
+
+def get_similar_cafes(cafe_id, limit=NEIGHBORS_PER_CAFE):
+    """Return rows of (id, name, version, score, co_likes) of cafes liked by
+    the same people as cafe, most similar first."""
+
+    return db.session.execute(
+        db.select(Cafe.id, Cafe.name, Cafe.version, CafeNeighbor.score,
+            CafeNeighbor.co_likes)
+        .join(CafeNeighbor, CafeNeighbor.neighbor_id == Cafe.id)
+        .where(CafeNeighbor.cafe_id == cafe_id)
+        .order_by(CafeNeighbor.score.desc(), Cafe.id)
+        .limit(limit)).all()
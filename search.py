@@ -0,0 +1,149 @@
+"""Full-text search over cafe names, descriptions and addresses.
+
+On PostgreSQL, queries are matched against Cafe.search_vector (kept current
+by models.set_search_vector, with a GIN index) and ranked with ts_rank.
+Other databases, like SQLite in development, use an in-process inverted
+index instead, which matches cafes having every word of the query.
+"""
+
+import heapq
+import re
+
+from indexes import SyncedIndex, get_identity
+from models import db, Cafe, SEARCH_CONFIG
+
+# like the A, B & C weights given to these fields in the search vector,
+# which ts_rank scores 1.0, 0.4 and 0.2 by default
+FIELD_WEIGHTS = {"name": 1.0, "description": 0.4, "address": 0.2}
+
+WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Return list of lowercased words in text."""
+
+    return WORD_RE.findall(text.lower()) if text else []
+
+
+class InvertedIndex:
+    """Maps each word to the documents containing it, with a weight for
+    how often (and in which fields) it appears."""
+
+    def __init__(self):
+        self.postings = {}
+        self.docs = {}
+
+    def add(self, id, fields):
+        """Index (or re-index) a document from dict of field name -> text."""
+
+        self.remove(id)
+
+        weights = {}
+        for field, text in fields.items():
+            for word in tokenize(text):
+                weights[word] = weights.get(word, 0) + FIELD_WEIGHTS[field]
+
+        for word, weight in weights.items():
+            self.postings.setdefault(word, {})[id] = weight
+
+        self.docs[id] = list(weights)
+
+    def remove(self, id):
+        """Remove a document from the index, if it's there."""
+
+        for word in self.docs.pop(id, ()):
+            postings = self.postings[word]
+            del postings[id]
+            if not postings:
+                del self.postings[word]
+
+    def search(self, query, limit=None, offset=0):
+        """Return [(id, score)] of documents containing every word of query,
+        best first."""
+
+        words = set(tokenize(query))
+        if not words:
+            return []
+
+        postings = sorted((self.postings.get(word, {}) for word in words),
+            key=len)
+
+        # intersect starting from the rarest word, so few ids are checked
+        matches = [(sum(posting[id] for posting in postings), id)
+            for id in postings[0]
+            if all(id in posting for posting in postings[1:])]
+
+        key = lambda match: (-match[0], match[1])
+        if limit is None:
+            matches.sort(key=key)
+        else:
+            matches = heapq.nsmallest(offset + limit, matches, key=key)
+
+        return [(id, score) for score, id in matches[offset:]]
+
+
+class CafeSearchIndex(SyncedIndex):
+    """Inverted index of cafes, for searching without PostgreSQL."""
+
+    models = (Cafe,)
+
+    def __init__(self):
+        super().__init__()
+        self.index = InvertedIndex()
+
+    def load(self):
+        index = InvertedIndex()
+
+        query = db.select(Cafe.id, Cafe.name, Cafe.description, Cafe.address)
+
+        for id, name, description, address in db.session.execute(query):
+            index.add(id, {"name": name, "description": description,
+                "address": address})
+
+        self.index = index
+
+    def snapshot(self, op, cafe):
+        if op == "delete":
+            return get_identity(cafe), None
+        return cafe.id, {"name": cafe.name, "description": cafe.description,
+            "address": cafe.address}
+
+    def apply(self, op, data):
+        id, fields = data
+
+        if fields is None:
+            self.index.remove(id)
+        else:
+            self.index.add(id, fields)
+
+    def search(self, query, limit=None, offset=0):
+        """Return [(cafe id, score)] of matching cafes, best first."""
+
+        self.ensure_loaded()
+        with self._lock:
+            return self.index.search(query, limit, offset)
+
+
+cafe_search_index = CafeSearchIndex()
+
+
+def search_cafes(query, limit=None, offset=0):
+    """Return [(cafe id, rank)] of cafes matching query, best first.
+
+    On PostgreSQL, query takes web search syntax: "quoted phrases", OR,
+    and -word to exclude a word.
+    """
+
+    if db.engine.dialect.name != 'postgresql':
+        return cafe_search_index.search(query, limit, offset)
+
+    tsquery = db.func.websearch_to_tsquery(SEARCH_CONFIG, query)
+    rank = db.func.ts_rank(Cafe.search_vector, tsquery, type_=db.Float)
+
+    select = (db.select(Cafe.id, rank)
+        .where(Cafe.search_vector.op('@@')(tsquery))
+        .order_by(rank.desc(), Cafe.id)
+        .limit(limit)
+        .offset(offset))
+
+    return [(id, rank) for id, rank in db.session.execute(select)]
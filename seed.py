@@ -1,6 +1,7 @@
 """Initial data."""
 
-from models import City, Cafe, User, db
+from models import City, Cafe, User, Like, MapJob, db
+from recommendations import rebuild_neighbors
 db.drop_all()
 db.create_all()
 
@@ -82,17 +83,18 @@ db.session.commit()
 #######################################
 # add likes
 
-u1.liked_cafes.append(c1)
-u1.liked_cafes.append(c2)
-ua.liked_cafes.append(c1)
+Like.add(u1.id, c1.id)
+Like.add(u1.id, c2.id)
+Like.add(ua.id, c1.id)
+rebuild_neighbors()
 
 db.session.commit()
 
 
 #######################################
-# cafe maps
+# cafe maps (downloaded by the background map workers)
 
-c1.save_map()
-c2.save_map()
+for cafe in [c1, c2, c3]:
+    MapJob.enqueue(cafe)
 
 db.session.commit()
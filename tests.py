@@ -1,12 +1,37 @@
 """Tests for Flask Cafe."""
 
 
+import json
+import os
 import re
+import shutil
+from datetime import datetime, timedelta
+import tempfile
 from unittest import TestCase
+from unittest.mock import Mock, patch
 
 from flask import session
-from app import app, CURR_USER_KEY
-from models import db, Cafe, City, connect_db, User, Like
+from werkzeug.http import http_date
+from app import app, CURR_USER_KEY, card_cache, page_cache, user_cache
+from models import db, Cafe, City, connect_db, User, Like, MapJob, CafeNeighbor
+import mapping
+from mapping import (get_map_key, get_map_path, save_map, CircuitBreaker,
+    CircuitOpenError, MapClient, MapDownloadError)
+from jobs import run_next_job, MapWorkerPool, MAX_ATTEMPTS
+from commands import write_progress
+from bench.mapquest_stub import start_stub
+from geo import GridIndex, haversine_km
+from query_stats import QUERY_COUNT_HEADER
+from pagination import encode_cursor
+from cache import LRUCache
+from user_cache import UserCache
+from page_cache import PAGE_CACHE_HEADER
+from search import InvertedIndex, search_cafes
+from autocomplete import SortedNames, normalize
+from trending import trending
+from recommendations import build_neighbors, rebuild_neighbors, get_similar_cafes
+from user_likes import LikedIds, liked_ids
+from passwords import bcrypt, hasher
 
 # Use test database and don't clutter tests with SQL
 app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///flaskcafe_test"
@@ -21,6 +46,9 @@ app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 # Don't req CSRF for testing
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Hash passwords at bcrypt's lowest cost, so tests don't wait on it
+app.config['BCRYPT_LOG_ROUNDS'] = 4
+
 connect_db(app)
 
 db.drop_all()
@@ -46,6 +74,41 @@ def login_for_test(client, user_id):
         sess[CURR_USER_KEY] = user_id
 
 
+def assert_query_budget(test, client, url, max_queries):
+    """Asserts that getting url succeeds with at most max_queries queries."""
+
+    resp = client.get(url)
+    count = int(resp.headers[QUERY_COUNT_HEADER])
+
+    test.assertEqual(resp.status_code, 200)
+    test.assertLessEqual(count, max_queries,
+        f"{url} made {count} queries; budget is {max_queries}")
+
+
+def mock_map_response(status_code=200, headers=None):
+    """Returns a fake MapQuest response for a map."""
+
+    return Mock(
+        ok=status_code < 400,
+        status_code=status_code,
+        headers=headers or {},
+        iter_content=Mock(return_value=[b"jp", b"eg"]),
+    )
+
+
+def fake_mapquest(url, **kwargs):
+    """Stands in for MapQuest: returns a map, or a location if geocoding."""
+
+    resp = mock_map_response()
+
+    if url == mapping.GEOCODE_URL:
+        resp.json.return_value = {"results": [{"locations": [
+            {"latLng": {"lat": 37.79, "lng": -122.40}},
+        ]}]}
+
+    return resp
+
+
 #######################################
 # data to use for test objects / testing forms
 
@@ -233,15 +296,14 @@ class CafeViewsTestCase(TestCase):
             self.assertIn(b'testcafe.com', resp.data)
 
 
-class CafeAdminViewsTestCase(TestCase):
-    """Tests for add/edit views on cafes."""
+class CafeCardCacheTestCase(TestCase):
+    """Tests for caching rendered cafe cards."""
 
     def setUp(self):
-        """Before each test, add sample city, users, and cafes"""
+        """Before each test, add sample city & cafe with an empty card cache."""
 
-        User.query.delete()
-        City.query.delete()
         Cafe.query.delete()
+        City.query.delete()
 
         sf = City(**CITY_DATA)
         db.session.add(sf)
@@ -249,344 +311,1818 @@ class CafeAdminViewsTestCase(TestCase):
         cafe = Cafe(**CAFE_DATA)
         db.session.add(cafe)
 
-        user = User.register(**ADMIN_USER_DATA)
-        db.session.add(user)
-
         db.session.commit()
 
         self.cafe_id = cafe.id
-        self.user_id = user.id
+        card_cache.clear()
 
     def tearDown(self):
-        """After each test, delete the cities."""
+        """After each test, remove all cafes."""
 
-        User.query.delete()
         Cafe.query.delete()
         City.query.delete()
         db.session.commit()
 
-    def test_add(self):
+    def test_card_cached(self):
         with app.test_client() as client:
-            with client.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.user_id
-
-            resp = client.get(f"/cafes/add")
-
-            self.assertIn(b'Add Cafe', resp.data)
-
-            resp = client.post(
-                f"/cafes/add",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-
-            self.assertIn(b'added', resp.data)
-
-    def test_dynamic_cities_vocab(self):
-        id = self.cafe_id
+            client.get("/cafes")
+            resp = client.get("/cafes")
 
-        # the following is a regular expression for the HTML for the drop-down
-        # menu pattern we want to check for
-        choices_pattern = re.compile(
-            r'<select [^>]*name="city_code"[^>]*><option [^>]*value="sf">' +
-            r'San Francisco</option></select>')
+            self.assertIn(b"Test Cafe", resp.data)
+            self.assertEqual(card_cache.hits, 1)
+            self.assertEqual(card_cache.misses, 1)
 
+    def test_card_invalidated_on_edit(self):
         with app.test_client() as client:
-            with client.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.user_id
-
-            resp = client.get(f"/cafes/add")
-            self.assertRegex(resp.data.decode('utf8'), choices_pattern)
-
-            resp = client.get(f"/cafes/{id}/edit")
-            self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+            client.get("/cafes")
 
-    def test_edit(self):
-        id = self.cafe_id
+            cafe = Cafe.query.get(self.cafe_id)
+            cafe.name = "Renamed Cafe"
+            db.session.commit()
 
-        with app.test_client() as client:
-            with client.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.user_id
+            self.assertEqual(cafe.version, 2)
 
-            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
-            self.assertIn(b'Edit Test Cafe', resp.data)
+            resp = client.get("/cafes")
+            self.assertIn(b"Renamed Cafe", resp.data)
 
-            resp = client.post(
-                f"/cafes/{id}/edit",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-            self.assertIn(b'edited', resp.data)
+            city = City.query.get("sf")
+            city.name = "San Fran"
+            db.session.commit()
 
-    def test_edit_form_shows_curr_data(self):
-        id = self.cafe_id
+            resp = client.get("/cafes")
+            self.assertIn(b"San Fran, CA", resp.data)
+            self.assertEqual(card_cache.misses, 3)
 
-        with app.test_client() as client:
-            with client.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.user_id
+    def test_unchanged_cafe_keeps_version(self):
+        cafe = Cafe.query.get(self.cafe_id)
+        cafe.name = cafe.name
+        db.session.commit()
 
-            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
-            self.assertIn(b'Test description', resp.data)
+        self.assertEqual(cafe.version, 1)
 
-    def test_get_choices(self):
-        """ tests the get_choices class method in class City"""
 
-        choices = City.get_choices()
+class LRUCacheTestCase(TestCase):
+    """Tests for the in-process LRU cache."""
 
-        self.assertIn(('sf', 'San Francisco') , choices)
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
 
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.evictions, 1)
 
+    def test_ttl(self):
+        cache = LRUCache()
+        cache.set("a", 1, ttl=0)
+        cache.set("b", 2, ttl=60)
 
-#######################################
-# users
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
 
 
-class UserModelTestCase(TestCase):
-    """Tests for the user model."""
+class ConditionalGetTestCase(TestCase):
+    """Tests for ETag / Last-Modified support on cafe pages & APIs."""
 
     def setUp(self):
-        """Before each test, add sample users."""
+        """Before each test, add sample city, cafe & user."""
 
         User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
 
         user = User.register(**TEST_USER_DATA)
 
         db.session.commit()
 
-        self.user = user
+        self.cafe_id = cafe.id
+        self.user_id = user.id
 
     def tearDown(self):
-        """After each test, remove all users."""
+        """After each test, remove all users & cafes."""
 
         User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
         db.session.commit()
 
-    def test_authenticate(self):
-        rez = User.authenticate("test", "secret")
-        self.assertEqual(rez, self.user)
-
-    def test_authenticate_fail(self):
-        rez = User.authenticate("no-such-user", "secret")
-        self.assertFalse(rez)
-
-        rez = User.authenticate("test", "password")
-        self.assertFalse(rez)
-
-    def test_full_name(self):
-        self.assertEqual(self.user.get_full_name(), "Testy MacTest")
-
-    def test_register(self):
-        u = User.register(**TEST_USER_DATA)
-        # test that password gets bcrypt-hashed (all start w/$2b$)
-        self.assertEqual(u.hashed_password[:4], "$2b$")
-        db.session.rollback()
+    def test_list_etag(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes")
+            etag = resp.headers["ETag"]
 
+            self.assertIn("no-cache", resp.headers["Cache-Control"])
 
-class AuthViewsTestCase(TestCase):
-    """Tests for views on logging in/logging out/registration."""
+            resp = client.get("/cafes", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
 
-    def setUp(self):
-        """Before each test, add sample users."""
+            cafe = Cafe.query.get(self.cafe_id)
+            cafe.description = "new-description"
+            db.session.commit()
 
-        User.query.delete()
+            resp = client.get("/cafes", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"new-description", resp.data)
 
-        user = User.register(**TEST_USER_DATA)
+    @patch("models.lookup_map", return_value="/static/images/maps/test.jpg")
+    def test_detail_if_modified_since_after_like(self, mock_lookup):
+        # liking doesn't change the cafe's updated_at, so the page has no
+        # Last-Modified to go stale
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertNotIn("Last-Modified", resp.headers)
 
-        db.session.commit()
+            since = http_date(datetime.utcnow())
+            client.put(f"/api/cafes/{self.cafe_id}/like")
 
-        self.user_id = user.id
+            with client.session_transaction() as sess:
+                logged_in = dict(sess)
 
-    def tearDown(self):
-        """After each test, remove all users."""
+            # logged in, then logged out
+            for sess in (logged_in, {}):
+                with client.session_transaction() as client_sess:
+                    client_sess.clear()
+                    client_sess.update(sess)
 
-        User.query.delete()
-        db.session.commit()
+                resp = client.get(f"/cafes/{self.cafe_id}",
+                    headers={"If-Modified-Since": since})
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('id="like-count">1<', resp.get_data(as_text=True))
 
-    def test_signup(self):
+    def test_etag_depends_on_user(self):
         with app.test_client() as client:
-            resp = client.get("/signup")
-            self.assertIn(b'Sign Up', resp.data)
-
-            resp = client.post(
-                "/signup",
-                data=TEST_USER_DATA_NEW,
-                follow_redirects=True,
-            )
+            etag = client.get(f"/cafes/{self.cafe_id}").headers["ETag"]
 
-            self.assertIn(b"You are signed up and logged in.", resp.data)
-            self.assertTrue(session.get(CURR_USER_KEY))
+            login_for_test(client, self.user_id)
+            resp = client.get(f"/cafes/{self.cafe_id}",
+                headers={"If-None-Match": etag})
 
-    def test_signup_username_taken(self):
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("private", resp.headers["Cache-Control"])
 
+    def test_no_304_with_flashed_messages(self):
         with app.test_client() as client:
-            resp = client.get("/signup")
-            self.assertIn(b'Sign Up', resp.data)
+            etag = client.get("/cafes").headers["ETag"]
 
-            # signup with same data as the already-added user
-            resp = client.post(
-                "/signup",
-                data=TEST_USER_DATA,
-                follow_redirects=True,
-            )
-
-            db.session.rollback()
+            with client.session_transaction() as sess:
+                sess["_flashes"] = [("success", "Hello!")]
 
-            self.assertIn(b"Username already taken", resp.data)
+            resp = client.get("/cafes", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Hello!", resp.data)
 
-    def test_login(self):
+    def test_likes_etag(self):
         with app.test_client() as client:
-            resp = client.get("/login")
-            self.assertIn(b'Welcome Back!', resp.data)
-
-            resp = client.post(
-                "/login",
-                data={"username": "test", "password": "WRONG"},
-                follow_redirects=True,
-            )
-
-            self.assertIn(b"Invalid credentials", resp.data)
+            login_for_test(client, self.user_id)
 
-            resp = client.post(
-                "/login",
-                data={"username": "test", "password": "secret"},
-                follow_redirects=True,
-            )
+            url = f"/api/likes?cafe_id={self.cafe_id}"
+            etag = client.get(url).headers["ETag"]
 
-            self.assertIn(b"Hello, test", resp.data)
-            self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
 
-    def test_logout(self):
-        with app.test_client() as client:
-            login_for_test(client, self.user_id)
-            resp = client.post("/logout", follow_redirects=True)
+            client.post("/api/likes", json={"cafe_id": self.cafe_id})
 
-            self.assertIn(b"successfully logged out", resp.data)
-            self.assertEqual(session.get(CURR_USER_KEY), None)
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.get_json(), {"likes": True})
 
 
-class NavBarTestCase(TestCase):
-    """Tests navigation bar."""
+class PageCacheTestCase(TestCase):
+    """Tests for the full-page cache for anonymous visitors."""
 
     def setUp(self):
-        """Before tests, add sample user."""
+        """Before each test, add sample city, cafe & user, and turn on the
+        page cache."""
 
         User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
 
         user = User.register(**TEST_USER_DATA)
 
-        db.session.add_all([user])
         db.session.commit()
 
         self.user_id = user.id
 
+        page_cache.backend.clear()
+        app.config['PAGE_CACHE_TTL'] = 30
+
     def tearDown(self):
-        """After tests, remove all users."""
+        """After each test, turn off the page cache and remove all data."""
+
+        app.config['PAGE_CACHE_TTL'] = 0
 
         User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
         db.session.commit()
 
-    def test_anon_navbar(self):
-        """ Tests that navbar only has access home, signup, and login tabs """
+    def test_anon_pages_cached(self):
         with app.test_client() as client:
-            # with client.session_transaction() as sess:
-            #     sess[CURR_USER_KEY] = None
+            resp = client.get("/cafes")
+            self.assertEqual(resp.headers[PAGE_CACHE_HEADER], "miss")
 
-            resp = client.get('/')
+            resp = client.get("/cafes")
+            self.assertEqual(resp.headers[PAGE_CACHE_HEADER], "hit")
+            self.assertEqual(resp.headers[QUERY_COUNT_HEADER], "0")
+            self.assertIn(b"Test Cafe", resp.data)
+            self.assertNotIn("Set-Cookie", resp.headers)
 
-            html = resp.get_data(as_text=True)
+            resp = client.get("/cafes",
+                headers={"If-None-Match": resp.headers["ETag"]})
+            self.assertEqual(resp.status_code, 304)
 
-            self.assertIn("Sign Up", html)
-            self.assertIn("Log In", html)
-            self.assertNotIn("Log Out", html)
-            self.assertEqual(session.get(CURR_USER_KEY), None)
+    def test_logged_in_not_cached(self):
+        with app.test_client() as client:
+            client.get("/cafes")
+
+            login_for_test(client, self.user_id)
+            resp = client.get("/cafes")
 
+            self.assertNotIn(PAGE_CACHE_HEADER, resp.headers)
+            self.assertIn(b"Log Out", resp.data)
 
-    def test_logged_in_navbar(self):
-        """ Test that user's fullname and logout tab are in the navbar """
+    def test_stale_page_served_while_regenerating(self):
         with app.test_client() as client:
-            with client.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.user_id
+            client.get("/cafes")
 
-            resp = client.get('/')
+            # expire the page, and pretend another request is regenerating it
+            entry = page_cache.backend.get("page:/cafes?")
+            entry["expires"] = 0
+            page_cache.backend.add("page:/cafes?:lock", True)
 
-            html = resp.get_data(as_text=True)
+            resp = client.get("/cafes")
+            self.assertEqual(resp.headers[PAGE_CACHE_HEADER], "stale")
 
-            self.assertIn("Log Out", html)
-            self.assertNotIn("Sign Up", html)
-            self.assertNotIn("Log In", html)
-            self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
+            page_cache.backend.delete("page:/cafes?:lock")
 
+            resp = client.get("/cafes")
+            self.assertEqual(resp.headers[PAGE_CACHE_HEADER], "miss")
 
-class ProfileViewsTestCase(TestCase):
-    """Tests for views on user profiles."""
+
+class CafePaginationTestCase(TestCase):
+    """Tests for paging through cafes."""
 
     def setUp(self):
-        """Before each test, add sample user."""
+        """Before each test, add cafes, two of them with the same name."""
 
-        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
 
-        user = User.register(**TEST_USER_DATA)
-        db.session.add(user)
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        names = ["Cafe A", "Cafe B", "Cafe B", "Cafe C", "Cafe D"]
+        cafes = [Cafe(**{**CAFE_DATA, "name": name}) for name in names]
+        db.session.add_all(cafes)
 
         db.session.commit()
 
-        self.user_id = user.id
+        self.cafe_ids = sorted((cafe.name, cafe.id) for cafe in cafes)
 
     def tearDown(self):
-        """After each test, remove all users."""
+        """After each test, remove all cafes."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_api_pages(self):
+        with app.test_client() as client:
+            seen = []
+            cursor = None
+            pages = []
+
+            while True:
+                resp = client.get("/api/cafes",
+                    query_string={"per_page": 2, "after": cursor or ""})
+                data = resp.get_json()
+
+                pages.append(data)
+                seen.extend((cafe["name"], cafe["id"]) for cafe in data["cafes"])
+
+                cursor = data["next"]
+                if not cursor:
+                    break
+
+            self.assertEqual(seen, self.cafe_ids)
+            self.assertEqual(len(pages), 3)
+            self.assertIsNone(pages[0]["prev"])
+
+            # step back from the last page to the one before it
+            resp = client.get("/api/cafes",
+                query_string={"per_page": 2, "before": pages[-1]["prev"]})
+
+            self.assertEqual(resp.get_json()["cafes"], pages[1]["cafes"])
+
+    def test_api_bad_cursor(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes", query_string={"after": "nope"})
+
+            self.assertEqual(resp.status_code, 400)
+
+    def test_wrong_type_cursors(self):
+        # valid JSON lists, but not (name, id)
+        cursors = [encode_cursor(values) for values in
+            (["a", "b"], [1, 2], [{}, 1], ["a", True], ["a", None], ["a", 1.5])]
+
+        with app.test_client() as client:
+            for cursor in cursors:
+                for url, args in (("/cafes", {}), ("/api/cafes", {}),
+                        ("/api/cafes", {"stream": "ndjson"})):
+                    for direction in ("after", "before"):
+                        if "stream" in args and direction == "before":
+                            continue
+
+                        resp = client.get(url,
+                            query_string={**args, direction: cursor})
+                        self.assertEqual(resp.status_code, 400)
+
+            # nothing failed in the database, so the session still works
+            self.assertEqual(client.get("/api/cafes").status_code, 200)
+
+    def test_list_pages(self):
+        with patch("app.CAFES_PER_PAGE", 3):
+            with app.test_client() as client:
+                resp = client.get("/cafes")
+                html = resp.get_data(as_text=True)
+
+                self.assertIn("Cafe A", html)
+                self.assertNotIn("Cafe C", html)
+                self.assertIn("Next", html)
+                self.assertNotIn("Previous", html)
+
+                next_url = re.search(r'href="(/cafes\?after=[^"]+)"',
+                    html).group(1)
+                resp = client.get(next_url)
+                html = resp.get_data(as_text=True)
+
+                self.assertIn("Cafe D", html)
+                self.assertNotIn("Cafe A", html)
+                self.assertIn("Previous", html)
+                self.assertNotIn("Next", html)
+
+
+class CafesAPITestCase(TestCase):
+    """Tests for reading cafes as JSON."""
+
+    def setUp(self):
+        """Before each test, add cafes in two cities."""
+
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+
+        cafes = [Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}) for i in range(5)]
+        cafes.append(Cafe(**{**CAFE_DATA, "name": "Oak Cafe", "city_code": "oak"}))
+        db.session.add_all(cafes)
+
+        db.session.commit()
+
+        self.sf_ids = [cafe.id for cafe in cafes[:5]]
+        self.oak_id = cafes[5].id
+
+    def tearDown(self):
+        """After each test, remove all cafes."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_fields(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes", query_string={"fields": "id,address"})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_json()["cafes"][0],
+                {"id": self.sf_ids[0], "address": CAFE_DATA["address"]})
+
+    def test_unknown_fields(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes", query_string={"fields": "id,password"})
+
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("password", resp.get_json()["error"])
+
+    def test_city_filter(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes",
+                query_string={"city": "oak", "fields": "id"})
+
+            self.assertEqual(resp.get_json()["cafes"], [{"id": self.oak_id}])
+
+            resp = client.get("/cafes", query_string={"city": "oak"})
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("Oak Cafe", html)
+            self.assertNotIn("Cafe 0", html)
+
+    def test_stream_ndjson(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes",
+                query_string={"stream": "ndjson", "fields": "id"})
+
+            self.assertEqual(resp.mimetype, "application/x-ndjson")
+            self.assertTrue(resp.is_streamed)
+
+            lines = resp.get_data(as_text=True).splitlines()
+            ids = [json.loads(line)["id"] for line in lines]
+            self.assertEqual(ids, self.sf_ids + [self.oak_id])
+
+    def test_stream_json(self):
+        with app.test_client() as client:
+            first = client.get("/api/cafes",
+                query_string={"per_page": 2, "fields": "id"}).get_json()
+
+            resp = client.get("/api/cafes", query_string={"stream": "json",
+                "fields": "id", "city": "sf", "after": first["next"]})
+
+            self.assertEqual(resp.get_json(),
+                {"cafes": [{"id": id} for id in self.sf_ids[2:]]})
+
+    def test_stream_bad_format(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes", query_string={"stream": "xml"})
+
+            self.assertEqual(resp.status_code, 400)
+
+    def test_show(self):
+        with app.test_client() as client:
+            resp = client.get(f"/api/cafes/{self.oak_id}",
+                query_string={"fields": "name,city_code"})
+
+            self.assertEqual(resp.get_json(),
+                {"cafe": {"name": "Oak Cafe", "city_code": "oak"}})
+
+    def test_show_missing(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes/0")
+
+            self.assertEqual(resp.status_code, 404)
+
+
+class CafeSearchTestCase(TestCase):
+    """Tests for full-text search of cafes."""
+
+    def setUp(self):
+        """Before each test, add cafes with different words in each field."""
+
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+
+        self.espresso = Cafe(**{**CAFE_DATA, "name": "Espresso Bar",
+            "description": "Small and loud"})
+        self.roastery = Cafe(**{**CAFE_DATA, "name": "Mission Roastery",
+            "description": "We roast our own espresso beans"})
+        self.tea = Cafe(**{**CAFE_DATA, "name": "Tea House",
+            "address": "1 Valencia St"})
+        db.session.add_all([self.espresso, self.roastery, self.tea])
+
+        db.session.commit()
+
+    def tearDown(self):
+        """After each test, remove all cafes."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_ranked(self):
+        # a name match outranks a description match
+        found = search_cafes("espresso")
+
+        self.assertEqual([id for id, rank in found],
+            [self.espresso.id, self.roastery.id])
+        self.assertGreater(found[0][1], found[1][1])
+
+    def test_stemmed_and_address(self):
+        self.assertEqual([id for id, rank in search_cafes("roasting")],
+            [self.roastery.id])
+        self.assertEqual([id for id, rank in search_cafes("valencia")],
+            [self.tea.id])
+
+    def test_kept_current(self):
+        self.tea.description = "Now serving espresso"
+        db.session.commit()
+
+        self.assertIn(self.tea.id, [id for id, rank in search_cafes("espresso")])
+
+        self.tea.description = "Just tea"
+        db.session.commit()
+
+        self.assertNotIn(self.tea.id,
+            [id for id, rank in search_cafes("espresso")])
+
+    def test_search_page(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes/search", query_string={"q": "espresso"})
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Espresso Bar", html)
+            self.assertIn("Mission Roastery", html)
+            self.assertNotIn("Tea House", html)
+
+            resp = client.get("/cafes/search", query_string={"q": "zzz"})
+
+            self.assertIn("No cafes found", resp.get_data(as_text=True))
+
+    def test_search_api(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes/search",
+                query_string={"q": "tea", "fields": "id,name"})
+            cafes = resp.get_json()["cafes"]
+
+            self.assertEqual(len(cafes), 1)
+            self.assertEqual(cafes[0]["name"], "Tea House")
+            self.assertIn("rank", cafes[0])
+
+            resp = client.get("/api/cafes/search")
+
+            self.assertEqual(resp.status_code, 400)
+
+
+class InvertedIndexTestCase(TestCase):
+    """Tests for the in-process search index used without PostgreSQL."""
+
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.add(1, {"name": "Espresso Bar", "description": "Loud",
+            "address": "1 Main St"})
+        self.index.add(2, {"name": "Roastery",
+            "description": "Espresso and tea", "address": "2 Main St"})
+
+    def test_ranked(self):
+        self.assertEqual([id for id, score in self.index.search("espresso")],
+            [1, 2])
+
+    def test_every_word(self):
+        self.assertEqual([id for id, score in self.index.search("Espresso TEA")],
+            [2])
+        self.assertEqual(self.index.search("espresso coffee"), [])
+        self.assertEqual(self.index.search("  "), [])
+
+    def test_limit_offset(self):
+        self.assertEqual(self.index.search("main", limit=1, offset=1),
+            [(2, 0.2)])
+
+    def test_update_remove(self):
+        self.index.add(1, {"name": "Tea Bar", "description": "",
+            "address": ""})
+        self.assertEqual([id for id, score in self.index.search("espresso")],
+            [2])
+
+        self.index.remove(2)
+        self.assertEqual(self.index.search("espresso"), [])
+        self.assertNotIn("roastery", self.index.postings)
+
+
+class SortedNamesTestCase(TestCase):
+    """Tests for prefix lookup of names."""
+
+    def setUp(self):
+        self.names = SortedNames()
+        self.names.build([("cafe", 1, "Mission Roastery"),
+            ("cafe", 2, "Café Réveille"), ("city", "sf", "San Francisco")])
+
+    def test_normalize(self):
+        self.assertEqual(normalize("  Café   RÉVEILLE "), "cafe reveille")
+
+    def test_complete(self):
+        self.assertEqual(self.names.complete("san", 10),
+            [("city", "sf", "San Francisco")])
+        self.assertEqual(self.names.complete("cafe r", 10),
+            [("cafe", 2, "Café Réveille")])
+        self.assertEqual(self.names.complete("", 10), [])
+
+    def test_later_words_after_whole_names(self):
+        self.names.add("cafe", 3, "Roast Co")
+
+        self.assertEqual(self.names.complete("roa", 10),
+            [("cafe", 3, "Roast Co"), ("cafe", 1, "Mission Roastery")])
+        self.assertEqual(self.names.complete("roa", 1),
+            [("cafe", 3, "Roast Co")])
+
+    def test_rename_remove(self):
+        self.names.add("cafe", 1, "Tea House")
+
+        self.assertEqual(self.names.complete("roa", 10), [])
+        self.assertEqual(self.names.complete("hou", 10),
+            [("cafe", 1, "Tea House")])
+
+        self.names.remove("cafe", 1)
+
+        self.assertEqual(self.names.complete("t", 10), [])
+        self.assertEqual(len(self.names.words), 2)
+
+
+class AutocompleteViewsTestCase(TestCase):
+    """Tests for the autocomplete API."""
+
+    def setUp(self):
+        """Before each test, add a city & cafe."""
+
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        self.cafe = Cafe(**{**CAFE_DATA, "name": "Sandy's Beans"})
+        db.session.add(self.cafe)
+
+        db.session.commit()
+
+    def tearDown(self):
+        """After each test, remove all cafes."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_autocomplete(self):
+        with app.test_client() as client:
+            resp = client.get("/api/autocomplete", query_string={"q": "sa"})
+
+            self.assertEqual(resp.get_json()["results"], [
+                {"type": "city", "id": "sf", "name": "San Francisco",
+                    "url": "/cafes?city=sf"},
+                {"type": "cafe", "id": self.cafe.id, "name": "Sandy's Beans",
+                    "url": f"/cafes/{self.cafe.id}"},
+            ])
+
+    def test_kept_current(self):
+        with app.test_client() as client:
+            client.get("/api/autocomplete", query_string={"q": "sa"})
+
+            self.cafe.name = "Beans & Co"
+            db.session.commit()
+
+            resp = client.get("/api/autocomplete", query_string={"q": "bea"})
+            results = resp.get_json()["results"]
+
+            self.assertEqual([result["name"] for result in results],
+                ["Beans & Co"])
+
+            resp = client.get("/api/autocomplete", query_string={"q": "sand"})
+
+            self.assertEqual(resp.get_json()["results"], [])
+
+
+class QueryBudgetTestCase(TestCase):
+    """Tests that cafe pages make a fixed number of queries."""
+
+    def setUp(self):
+        """Before each test, add cafes in many cities & a user who likes them."""
+
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        cities = [City(code=f"c{i}", name=f"City {i}", state="CA")
+            for i in range(10)]
+        cafes = [Cafe(**{**CAFE_DATA, "city_code": f"c{i}"})
+            for i in range(10)]
+
+        user = User.register(**TEST_USER_DATA)
+        user.liked_cafes.extend(cafes[:5])
+
+        db.session.add_all(cities + cafes)
+        db.session.commit()
+
+        self.cafe_id = cafes[0].id
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove all users & cafes."""
+
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_list_budget(self):
+        with app.test_client() as client:
+            assert_query_budget(self, client, "/cafes", 1)
+
+            login_for_test(client, self.user_id)
+            assert_query_budget(self, client, "/cafes", 2)
+
+    def test_detail_budget(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            # cafe (with city), similar cafes, and the user & their liked ids
+            assert_query_budget(self, client, f"/cafes/{self.cafe_id}", 4)
+
+    def test_query_headers(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes")
+
+            self.assertEqual(resp.headers[QUERY_COUNT_HEADER], "1")
+            self.assertIn("X-DB-Time-Ms", resp.headers)
+
+
+class CafeAdminViewsTestCase(TestCase):
+    """Tests for add/edit views on cafes."""
+
+    def setUp(self):
+        """Before each test, add sample city, users, and cafes"""
+
+        User.query.delete()
+        City.query.delete()
+        Cafe.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+
+        user = User.register(**ADMIN_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, delete the cities."""
+
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_add(self):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = client.get(f"/cafes/add")
+
+            self.assertIn(b'Add Cafe', resp.data)
+
+            resp = client.post(
+                f"/cafes/add",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+
+            self.assertIn(b'added', resp.data)
+
+    def test_dynamic_cities_vocab(self):
+        id = self.cafe_id
+
+        # the following is a regular expression for the HTML for the drop-down
+        # menu pattern we want to check for
+        choices_pattern = re.compile(
+            r'<select [^>]*name="city_code"[^>]*><option [^>]*value="sf">' +
+            r'San Francisco</option></select>')
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = client.get(f"/cafes/add")
+            self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+
+            resp = client.get(f"/cafes/{id}/edit")
+            self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+
+    def test_edit(self):
+        id = self.cafe_id
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
+            self.assertIn(b'Edit Test Cafe', resp.data)
+
+            resp = client.post(
+                f"/cafes/{id}/edit",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+            self.assertIn(b'edited', resp.data)
+
+    def test_edit_form_shows_curr_data(self):
+        id = self.cafe_id
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
+            self.assertIn(b'Test description', resp.data)
+
+    def test_get_choices(self):
+        """ tests the get_choices class method in class City"""
+
+        choices = City.get_choices()
+
+        self.assertIn(('sf', 'San Francisco') , choices)
+
+
+
+#######################################
+# maps
+
+
+class MapStoreTestCase(TestCase):
+    """Tests for the content-addressed map store."""
+
+    def setUp(self):
+        """Before each test, make an empty map store."""
+
+        self.maps_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """After each test, remove the map store."""
+
+        shutil.rmtree(self.maps_dir)
+
+    def test_map_key(self):
+        key = get_map_key("500 Sansome St", "sf", "CA")
+
+        self.assertEqual(key, get_map_key(" 500  sansome st", "SF", "ca"))
+        self.assertNotEqual(key, get_map_key("500 Sansome St", "sf", "CA",
+            zoom=12))
+
+    @patch("mapping.client.session.get")
+    def test_save_map_fetches_once(self, mock_get):
+        mock_get.return_value = mock_map_response()
+
+        url = save_map("500 Sansome St", "sf", "CA", maps_dir=self.maps_dir)
+        again = save_map("500 Sansome St", "sf", "CA", maps_dir=self.maps_dir)
+
+        self.assertEqual(url, again)
+        self.assertTrue(url.startswith("/static/images/maps/"))
+        self.assertEqual(mock_get.call_count, 1)
+
+    @patch("mapping.client.session.get")
+    def test_save_map_failed_download(self, mock_get):
+        mock_get.return_value = mock_map_response(403)
+
+        with self.assertRaises(MapDownloadError) as cm:
+            save_map("500 Sansome St", "sf", "CA", maps_dir=self.maps_dir)
+
+        self.assertEqual(cm.exception.status_code, 403)
+
+    @patch("mapping.client.session.get")
+    def test_save_map_streams_to_file(self, mock_get):
+        mock_get.return_value = mock_map_response()
+
+        url = save_map("500 Sansome St", "sf", "CA", maps_dir=self.maps_dir)
+        key = get_map_key("500 Sansome St", "sf", "CA")
+
+        with open(get_map_path(key, self.maps_dir), 'rb') as fp:
+            self.assertEqual(fp.read(), b"jpeg")
+
+        # no temp files left behind
+        self.assertEqual(sorted(os.listdir(self.maps_dir)),
+            [f"{key}.jpg", f"{key}.json"])
+
+    @patch("mapping.client.session.get")
+    def test_save_map_revalidates(self, mock_get):
+        mock_get.return_value = mock_map_response(
+            headers={"ETag": '"v1"', "Last-Modified": "Tue, 1 Aug 2023"})
+        save_map("500 Sansome St", "sf", "CA", maps_dir=self.maps_dir)
+
+        mock_get.return_value = mock_map_response(304)
+        url = save_map("500 Sansome St", "sf", "CA", maps_dir=self.maps_dir,
+            force=True)
+
+        headers = mock_get.call_args.kwargs["headers"]
+        self.assertEqual(headers["If-None-Match"], '"v1"')
+        self.assertEqual(headers["If-Modified-Since"], "Tue, 1 Aug 2023")
+        self.assertTrue(url.startswith("/static/images/maps/"))
+        mock_get.return_value.iter_content.assert_not_called()
+
+    def test_save_map_with_stub_server(self):
+        stub = start_stub(payload_size=1000)
+
+        try:
+            with patch("mapping.BASE_URL", stub.base_url):
+                save_map("500 Sansome St", "sf", "CA", maps_dir=self.maps_dir)
+                save_map("500 Sansome St", "sf", "CA", maps_dir=self.maps_dir,
+                    force=True)
+        finally:
+            stub.shutdown()
+
+        key = get_map_key("500 Sansome St", "sf", "CA")
+        self.assertEqual(os.path.getsize(get_map_path(key, self.maps_dir)),
+            1000)
+        self.assertEqual(stub.requests, 2)
+
+
+class MapClientTestCase(TestCase):
+    """Tests for the MapQuest client and its circuit breaker."""
+
+    def setUp(self):
+        """Before each test, make a client whose breaker trips quickly."""
+
+        self.client = MapClient(breaker=CircuitBreaker(failure_threshold=2,
+            reset_timeout=60))
+
+    def test_breaker_opens(self):
+        with patch.object(self.client.session, "get") as mock_get:
+            mock_get.return_value = Mock(status_code=503)
+
+            self.client.get("http://maps.test/")
+            self.client.get("http://maps.test/")
+            self.assertEqual(self.client.breaker.state, 'open')
+
+            with self.assertRaises(CircuitOpenError):
+                self.client.get("http://maps.test/")
+
+            self.assertEqual(mock_get.call_count, 2)
+
+        stats = self.client.get_stats()
+        self.assertEqual(stats["failures"], 2)
+        self.assertEqual(stats["rejected"], 1)
+        self.assertEqual(stats["breaker"], 'open')
+
+    def test_breaker_half_open(self):
+        breaker = self.client.breaker
+        breaker.record_failure()
+        breaker.record_failure()
+
+        # pretend the cool-down has passed
+        breaker.opened_at -= breaker.reset_timeout
+        self.assertEqual(breaker.state, 'half-open')
+
+        # only one trial call is let through
+        breaker.before_call()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_timeout_passed(self):
+        with patch.object(self.client.session, "get") as mock_get:
+            mock_get.return_value = Mock(status_code=200)
+
+            self.client.get("http://maps.test/")
+
+            self.assertEqual(mock_get.call_args.kwargs["timeout"],
+                self.client.timeout)
+
+
+class MapJobTestCase(TestCase):
+    """Tests for background map jobs."""
+
+    def setUp(self):
+        """Before each test, add sample city & cafe with an empty map store."""
+
+        MapJob.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+
+        self.maps_dir = tempfile.mkdtemp()
+        self.maps_dir_patch = patch("mapping.MAPS_DIR", self.maps_dir)
+        self.maps_dir_patch.start()
+
+    def tearDown(self):
+        """After each test, remove all jobs & cafes and the map store."""
+
+        self.maps_dir_patch.stop()
+        shutil.rmtree(self.maps_dir)
+
+        MapJob.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    @patch("mapping.client.session.get")
+    def test_detail_doesnt_queue_job(self, mock_get):
+        job = MapJob(cafe_id=self.cafe_id, status='failed')
+        db.session.add(job)
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{self.cafe_id}")
+
+            self.assertIn(b"Map coming soon", resp.data)
+            mock_get.assert_not_called()
+
+        # the failed job isn't started again by viewing the cafe
+        self.assertEqual(
+            MapJob.query.filter_by(cafe_id=self.cafe_id).count(), 1)
+        self.assertEqual(MapJob.query.filter_by(status='pending').count(), 0)
+
+    @patch("mapping.client.session.get")
+    def test_run_job(self, mock_get):
+        mock_get.side_effect = fake_mapquest
+
+        job = MapJob.enqueue(Cafe.query.get(self.cafe_id))
+        db.session.commit()
+
+        self.assertTrue(run_next_job())
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.cafe.latitude, 37.79)
+        self.assertFalse(run_next_job())
+
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertIn(b"/static/images/maps/", resp.data)
+
+    @patch("mapping.client.session.get")
+    def test_run_job_retries(self, mock_get):
+        mock_get.return_value = mock_map_response(403)
+
+        job = MapJob.enqueue(Cafe.query.get(self.cafe_id))
+        db.session.commit()
+
+        self.assertTrue(run_next_job())
+        self.assertEqual(job.status, 'pending')
+        self.assertEqual(job.attempts, 1)
+        self.assertIn("HTTP 403", job.last_error)
+
+        # not due again until its backoff has passed
+        self.assertFalse(run_next_job())
+
+        for i in range(MAX_ATTEMPTS - 1):
+            job.run_after = datetime.utcnow()
+            db.session.commit()
+            run_next_job()
+
+        self.assertEqual(job.status, 'failed')
+
+    @patch("mapping.client.session.get")
+    def test_run_job_breaker_open(self, mock_get):
+        job = MapJob.enqueue(Cafe.query.get(self.cafe_id))
+        db.session.commit()
+
+        with patch("mapping.client.breaker.before_call",
+                side_effect=CircuitOpenError("open")):
+            for i in range(MAX_ATTEMPTS + 1):
+                job.run_after = datetime.utcnow()
+                db.session.commit()
+                self.assertTrue(run_next_job())
+
+        # an outage doesn't use up the job's attempts
+        mock_get.assert_not_called()
+        self.assertEqual(job.status, 'pending')
+        self.assertEqual(job.attempts, 0)
+        self.assertGreater(job.run_after, datetime.utcnow())
+
+    @patch("jobs.threading.Thread")
+    def test_workers_start_once(self, mock_thread):
+        pool = MapWorkerPool(Mock(testing=False), 2)
+
+        pool.start()
+        pool.start()
+
+        self.assertEqual(mock_thread.call_count, 2)
+
+        # tests run jobs themselves
+        MapWorkerPool(app, 2).start()
+        self.assertEqual(mock_thread.call_count, 2)
+
+    def test_edit_queues_job_on_new_address(self):
+        cafe = Cafe.query.get(self.cafe_id)
+
+        cafe.description = "new-description"
+        self.assertFalse(cafe.location_changed())
+
+        cafe.address = "1 Market St"
+        self.assertTrue(cafe.location_changed())
+
+        db.session.rollback()
+
+
+class GridIndexTestCase(TestCase):
+    """Tests for the spatial grid index."""
+
+    def setUp(self):
+        """Before each test, index a grid of points around SF."""
+
+        self.grid = GridIndex(cell_size=0.01)
+        self.points = {}
+
+        for i in range(20):
+            for j in range(20):
+                id = i * 20 + j
+                self.points[id] = (37.7 + i * 0.007, -122.5 + j * 0.009)
+                self.grid.add(id, *self.points[id])
+
+    def brute_force(self, lat, lng):
+        """Return [(distance, id)] of every point, nearest first."""
+
+        return sorted((haversine_km(lat, lng, *point), id)
+            for id, point in self.points.items())
+
+    def test_within(self):
+        expected = [(dist, id) for dist, id in self.brute_force(37.75, -122.45)
+            if dist <= 2]
+
+        self.assertEqual(self.grid.within(37.75, -122.45, 2), expected)
+        self.assertEqual(self.grid.within(37.75, -122.45, 2, limit=3),
+            expected[:3])
+
+    def test_nearest(self):
+        for lat, lng in [(37.75, -122.45), (37.6, -122.6), (40.7, -74.0)]:
+            self.assertEqual(self.grid.nearest(lat, lng, 5),
+                self.brute_force(lat, lng)[:5])
+
+    def test_move_and_remove(self):
+        self.grid.add(0, 40.7, -74.0)
+        self.assertEqual(self.grid.nearest(40.7, -74.0, 1)[0][1], 0)
+
+        self.grid.remove(0)
+        self.assertNotIn(0, self.grid.points)
+        self.assertEqual(len(self.grid), 399)
+
+
+class NearbyViewsTestCase(TestCase):
+    """Tests for the nearby cafes API."""
+
+    def setUp(self):
+        """Before each test, add cafes at known locations."""
+
+        Cafe.query.delete()
+        City.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        near = Cafe(**CAFE_DATA, latitude=37.7946, longitude=-122.4010)
+        far = Cafe(**{**CAFE_DATA, "name": "Far Cafe"},
+            latitude=37.7596, longitude=-122.4269)
+        unknown = Cafe(**{**CAFE_DATA, "name": "Ungeocoded Cafe"})
+        db.session.add_all([near, far, unknown])
+
+        db.session.commit()
+
+        self.near_id = near.id
+        self.far_id = far.id
+
+    def tearDown(self):
+        """After each test, remove all cafes."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_nearby_radius(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes/nearby",
+                query_string={"lat": 37.7946, "lng": -122.4010, "radius": 1})
+
+            cafes = resp.get_json()["cafes"]
+            self.assertEqual([cafe["id"] for cafe in cafes], [self.near_id])
+            self.assertEqual(cafes[0]["distance_km"], 0)
+
+            resp = client.get("/api/cafes/nearby",
+                query_string={"lat": 37.7946, "lng": -122.4010})
+
+            cafes = resp.get_json()["cafes"]
+            self.assertEqual([cafe["id"] for cafe in cafes],
+                [self.near_id, self.far_id])
+
+    def test_nearby_limit(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes/nearby",
+                query_string={"lat": 37.75, "lng": -122.43, "limit": 1})
+
+            cafes = resp.get_json()["cafes"]
+            self.assertEqual([cafe["id"] for cafe in cafes], [self.far_id])
+
+    def test_nearby_sees_new_cafes(self):
+        with app.test_client() as client:
+            client.get("/api/cafes/nearby", query_string={"lat": 0, "lng": 0})
+
+            cafe = Cafe.query.get(self.far_id)
+            cafe.latitude, cafe.longitude = 0.001, 0.001
+            db.session.commit()
+
+            resp = client.get("/api/cafes/nearby",
+                query_string={"lat": 0, "lng": 0})
+
+            cafes = resp.get_json()["cafes"]
+            self.assertEqual([cafe["id"] for cafe in cafes], [self.far_id])
+
+    def test_nearby_bad_location(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes/nearby", query_string={"lat": "x"})
+
+            self.assertEqual(resp.status_code, 400)
+
+    def test_nearby_not_finite(self):
+        location = {"lat": 37.77, "lng": -122.42}
+
+        with app.test_client() as client:
+            for args in ({"lat": "nan"}, {"lng": "nan"}, {"lat": "inf"},
+                    {"lng": "-inf"}, {"radius": "nan"}, {"radius": "inf"}):
+                resp = client.get("/api/cafes/nearby",
+                    query_string={**location, **args})
+
+                self.assertEqual(resp.status_code, 400)
+
+
+class RebuildMapsTestCase(TestCase):
+    """Tests for the maps rebuild command."""
+
+    def setUp(self):
+        """Before each test, add sample city & cafes with an empty map store."""
+
+        Cafe.query.delete()
+        City.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafes = [Cafe(**{**CAFE_DATA, "address": f"{i} Market St"})
+            for i in range(3)]
+        db.session.add_all(cafes)
+
+        db.session.commit()
+
+        self.cafe_ids = [cafe.id for cafe in cafes]
+
+        self.maps_dir = tempfile.mkdtemp()
+        self.maps_dir_patch = patch("mapping.MAPS_DIR", self.maps_dir)
+        self.maps_dir_patch.start()
+
+    def tearDown(self):
+        """After each test, remove all cafes and the map store."""
+
+        self.maps_dir_patch.stop()
+        shutil.rmtree(self.maps_dir)
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    @patch("mapping.client.session.get")
+    def test_rebuild(self, mock_get):
+        mock_get.return_value = mock_map_response()
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["maps", "rebuild", "--restart",
+            "--batch-size", "2"])
+
+        self.assertIn("3 maps", result.output)
+        self.assertEqual(mock_get.call_count, 3)
+        maps = [name for name in os.listdir(self.maps_dir)
+            if name.endswith(".jpg")]
+        self.assertEqual(len(maps), 3)
+
+    @patch("mapping.client.session.get")
+    def test_rebuild_resumes(self, mock_get):
+        mock_get.return_value = mock_map_response()
+
+        write_progress(self.cafe_ids[0])
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["maps", "rebuild"])
+
+        self.assertIn(f"Resuming after cafe {self.cafe_ids[0]}", result.output)
+        self.assertEqual(mock_get.call_count, 2)
+
+
+#######################################
+# users
+
+
+class UserModelTestCase(TestCase):
+    """Tests for the user model."""
+
+    def setUp(self):
+        """Before each test, add sample users."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+
+        db.session.commit()
+
+        self.user = user
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_authenticate(self):
+        rez = User.authenticate("test", "secret")
+        self.assertEqual(rez, self.user)
+
+    def test_authenticate_fail(self):
+        rez = User.authenticate("no-such-user", "secret")
+        self.assertFalse(rez)
+
+        rez = User.authenticate("test", "password")
+        self.assertFalse(rez)
+
+    def test_full_name(self):
+        self.assertEqual(self.user.get_full_name(), "Testy MacTest")
+
+    def test_register(self):
+        u = User.register(**TEST_USER_DATA)
+        # test that password gets bcrypt-hashed (all start w/$2b$)
+        self.assertEqual(u.hashed_password[:4], "$2b$")
+        db.session.rollback()
+
+
+class PasswordHasherTestCase(TestCase):
+    """Tests for hashing passwords at the configured cost."""
+
+    def setUp(self):
+        """Before each test, add a user whose password was hashed at an
+        older cost."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        user.hashed_password = bcrypt.generate_password_hash(
+            "secret", 5).decode('UTF-8')
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_configured_cost(self):
+        hashed = hasher.hash("secret")
+
+        self.assertEqual(hashed[:7], "$2b$04$")
+        self.assertFalse(hasher.needs_rehash(hashed))
+        self.assertTrue(hasher.verify(hashed, "secret"))
+        self.assertFalse(hasher.verify(hashed, "WRONG"))
+
+    def test_needs_rehash(self):
+        self.assertTrue(hasher.needs_rehash(
+            User.query.get(self.user_id).hashed_password))
+        self.assertTrue(hasher.needs_rehash("not a hash"))
+
+    def test_rehash_on_login(self):
+        with app.test_client() as client:
+            client.post("/login", data={"username": "test", "password": "WRONG"})
+            db.session.expire_all()
+            self.assertEqual(
+                User.query.get(self.user_id).hashed_password[:7], "$2b$05$")
+
+            client.post("/login", data={"username": "test", "password": "secret"})
+            db.session.expire_all()
+            user = User.query.get(self.user_id)
+
+            self.assertEqual(user.hashed_password[:7], "$2b$04$")
+            self.assertTrue(User.authenticate("test", "secret"))
+
+    def test_unknown_user_verifies(self):
+        verified = hasher.get_stats()["verify"]["count"]
+
+        self.assertFalse(User.authenticate("no-such-user", "secret"))
+
+        # as slow as a wrong password, at the configured cost
+        self.assertEqual(hasher.get_stats()["verify"]["count"], verified + 1)
+        self.assertFalse(hasher.needs_rehash(hasher._dummy_hash))
+
+    def test_stats(self):
+        verified = hasher.get_stats()["verify"]["count"]
+
+        User.authenticate("test", "WRONG")
+        stats = hasher.get_stats()
+
+        self.assertEqual(stats["verify"]["count"], verified + 1)
+        self.assertGreater(stats["verify"]["max_ms"], 0)
+        self.assertEqual(stats["log_rounds"], 4)
+
+
+class AuthViewsTestCase(TestCase):
+    """Tests for views on logging in/logging out/registration."""
+
+    def setUp(self):
+        """Before each test, add sample users."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_signup(self):
+        with app.test_client() as client:
+            resp = client.get("/signup")
+            self.assertIn(b'Sign Up', resp.data)
+
+            resp = client.post(
+                "/signup",
+                data=TEST_USER_DATA_NEW,
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"You are signed up and logged in.", resp.data)
+            self.assertTrue(session.get(CURR_USER_KEY))
+
+    def test_signup_username_taken(self):
+
+        with app.test_client() as client:
+            resp = client.get("/signup")
+            self.assertIn(b'Sign Up', resp.data)
+
+            # signup with same data as the already-added user
+            resp = client.post(
+                "/signup",
+                data=TEST_USER_DATA,
+                follow_redirects=True,
+            )
+
+            db.session.rollback()
+
+            self.assertIn(b"Username already taken", resp.data)
+
+    def test_signup_email_taken(self):
+        hashed = hasher.get_stats()["hash"]["count"]
+
+        with app.test_client() as client:
+            resp = client.post(
+                "/signup",
+                data={**TEST_USER_DATA_NEW, "email": TEST_USER_DATA["email"]},
+            )
+
+            self.assertIn(b"Email already taken", resp.data)
+            self.assertIsNone(session.get(CURR_USER_KEY))
+
+        # found before hashing the password
+        self.assertEqual(hasher.get_stats()["hash"]["count"], hashed)
+
+    def test_signup_race(self):
+        # someone signs up with the same username between check and commit
+        with app.test_client() as client:
+            with patch.object(User, "get_taken",
+                    return_value={"username": False, "email": False}):
+                resp = client.post("/signup", data=TEST_USER_DATA)
+
+            self.assertIn(b"Username already taken", resp.data)
+
+        # the failed insert was rolled back, so the session is usable
+        self.assertEqual(User.query.count(), 1)
+
+    def test_users_available(self):
+        with app.test_client() as client:
+            resp = client.get("/api/users/available",
+                query_string={"username": "test", "email": "new@test.com"})
+            self.assertEqual(resp.json, {"username": False, "email": True})
+
+            resp = client.get("/api/users/available",
+                query_string={"username": "new-username"})
+            self.assertEqual(resp.json, {"username": True})
+
+            resp = client.get("/api/users/available")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_login(self):
+        with app.test_client() as client:
+            resp = client.get("/login")
+            self.assertIn(b'Welcome Back!', resp.data)
+
+            resp = client.post(
+                "/login",
+                data={"username": "test", "password": "WRONG"},
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"Invalid credentials", resp.data)
+
+            resp = client.post(
+                "/login",
+                data={"username": "test", "password": "secret"},
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"Hello, test", resp.data)
+            self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
+
+    def test_logout(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.post("/logout", follow_redirects=True)
+
+            self.assertIn(b"successfully logged out", resp.data)
+            self.assertEqual(session.get(CURR_USER_KEY), None)
+
+
+class NavBarTestCase(TestCase):
+    """Tests navigation bar."""
+
+    def setUp(self):
+        """Before tests, add sample user."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+
+        db.session.add_all([user])
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After tests, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_anon_navbar(self):
+        """ Tests that navbar only has access home, signup, and login tabs """
+        with app.test_client() as client:
+            # with client.session_transaction() as sess:
+            #     sess[CURR_USER_KEY] = None
+
+            resp = client.get('/')
+
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("Sign Up", html)
+            self.assertIn("Log In", html)
+            self.assertNotIn("Log Out", html)
+            self.assertEqual(session.get(CURR_USER_KEY), None)
+
+
+    def test_logged_in_navbar(self):
+        """ Test that user's fullname and logout tab are in the navbar """
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = client.get('/')
+
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("Log Out", html)
+            self.assertNotIn("Sign Up", html)
+            self.assertNotIn("Log In", html)
+            self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
+
+
+class ProfileViewsTestCase(TestCase):
+    """Tests for views on user profiles."""
+
+    def setUp(self):
+        """Before each test, add sample user."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_anon_profile(self):
+        """ Tests that user cannot access profile routes """
+        with app.test_client() as client:
+
+            resp = client.get('/profile',
+                follow_redirects=True)
+
+            html = resp.get_data(as_text=True)
+
+            self.assertIn('You are not logged in.', html)
+            self.assertEqual(session.get(CURR_USER_KEY), None)
+
+    def test_logged_in_profile(self):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            user = User.query.get_or_404(self.user_id)
+            resp = client.get('/profile')
+
+            html = resp.get_data(as_text=True)
+
+            self.assertIn(user.get_full_name(), html)
+            self.assertTrue(session.get(CURR_USER_KEY))
+
+    def test_anon_profile_edit(self):
+        """ Tests that user cannot access profile edit form """
+        with app.test_client() as client:
+
+            resp = client.get('/profile/edit',
+                follow_redirects=True)
+
+            html = resp.get_data(as_text=True)
+
+            self.assertIn('You are not logged in.', html)
+            self.assertEqual(session.get(CURR_USER_KEY), None)
+
+    def test_logged_in_profile_edit(self):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            user = User.query.get_or_404(self.user_id)
+            resp = client.post('/profile/edit',
+                data=TEST_USER_DATA_EDIT,
+                follow_redirects=True)
+
+            html = resp.get_data(as_text=True)
+
+            self.assertIn(user.get_full_name(), html)
+            self.assertTrue(session.get(CURR_USER_KEY))
+
+
+class UserCacheTestCase(TestCase):
+    """Tests for loading the logged in user lazily, from a cache."""
+
+    def setUp(self):
+        """Before each test, add sample user & cafe."""
+
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add(Cafe(**CAFE_DATA))
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove all users & cafes."""
+
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_not_loaded_unless_used(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            not_needed = user_cache.stats["not_needed"]
+
+            resp = client.get("/api/cafes")
+
+            self.assertEqual(resp.headers[QUERY_COUNT_HEADER], "1")
+            self.assertEqual(user_cache.stats["not_needed"], not_needed + 1)
+
+    def test_cached(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            assert_query_budget(self, client, "/cafes", 2)
+            hits = user_cache.stats["hits"]
+
+            # the user comes from the cache now; only likes_version (for
+            # the ETag) is read
+            assert_query_budget(self, client, "/cafes", 2)
+            self.assertEqual(user_cache.stats["hits"], hits + 1)
 
-        User.query.delete()
-        db.session.commit()
+    def test_likes_version_not_cached(self):
+        # another process, with its own cache, that forget() can't reach
+        other_cache = UserCache(LRUCache(max_size=10))
+        cafe_id = Cafe.query.one().id
 
-    def test_anon_profile(self):
-        """ Tests that user cannot access profile routes """
         with app.test_client() as client:
+            login_for_test(client, self.user_id)
 
-            resp = client.get('/profile',
-                follow_redirects=True)
+            with patch("app.user_cache", other_cache):
+                resp = client.get("/api/likes",
+                    query_string={"cafe_id": cafe_id})
+                etag = resp.headers["ETag"]
+                self.assertEqual(resp.json, {"likes": False})
 
-            html = resp.get_data(as_text=True)
+            client.put(f"/api/cafes/{cafe_id}/like")
 
-            self.assertIn('You are not logged in.', html)
-            self.assertEqual(session.get(CURR_USER_KEY), None)
+            with patch("app.user_cache", other_cache):
+                resp = client.post("/api/likes/status",
+                    json={"cafe_ids": [cafe_id]})
+                self.assertEqual(resp.json, {"likes": {str(cafe_id): True}})
 
-    def test_logged_in_profile(self):
+                resp = client.get("/api/likes",
+                    query_string={"cafe_id": cafe_id},
+                    headers={"If-None-Match": etag})
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.json, {"likes": True})
+
+    def test_slim(self):
+        user_cache.forget(self.user_id)
+        db.session.expunge_all()
+
+        user = user_cache.get(self.user_id)
+
+        self.assertIn("hashed_password", db.inspect(user).unloaded)
+        self.assertEqual(user.email, TEST_USER_DATA["email"])
+
+    def test_forgotten_on_edit(self):
         with app.test_client() as client:
-            with client.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.user_id
+            login_for_test(client, self.user_id)
+            client.get("/cafes")
 
-            user = User.query.get_or_404(self.user_id)
-            resp = client.get('/profile')
+            client.post("/profile/edit", data=TEST_USER_DATA_EDIT)
+            html = client.get("/cafes").get_data(as_text=True)
 
-            html = resp.get_data(as_text=True)
+            self.assertIn(TEST_USER_DATA_EDIT["first_name"], html)
 
-            self.assertIn(user.get_full_name(), html)
-            self.assertTrue(session.get(CURR_USER_KEY))
 
-    def test_anon_profile_edit(self):
-        """ Tests that user cannot access profile edit form """
+class CSRFFormTestCase(TestCase):
+    """Tests that the logout form & its CSRF token are only made if used."""
+
+    def setUp(self):
+        """Before each test, add sample user, and turn CSRF checks on."""
+
+        User.query.delete()
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+        db.session.commit()
+
+        self.user_id = user.id
+
+        self.config_patch = patch.dict(app.config, {"WTF_CSRF_ENABLED": True})
+        self.config_patch.start()
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        self.config_patch.stop()
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_anon_session_untouched(self):
         with app.test_client() as client:
+            resp = client.get("/")
 
-            resp = client.get('/profile/edit',
-                follow_redirects=True)
+            self.assertNotIn("Set-Cookie", resp.headers)
 
-            html = resp.get_data(as_text=True)
+    def test_not_made_for_api(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
 
-            self.assertIn('You are not logged in.', html)
-            self.assertEqual(session.get(CURR_USER_KEY), None)
+            with patch("app.CSRFProtectionForm") as mock_form:
+                client.get("/api/cafes")
 
-    def test_logged_in_profile_edit(self):
+            mock_form.assert_not_called()
+
+    def test_logout(self):
         with app.test_client() as client:
-            with client.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.user_id
+            login_for_test(client, self.user_id)
 
-            user = User.query.get_or_404(self.user_id)
-            resp = client.post('/profile/edit',
-                data=TEST_USER_DATA_EDIT,
-                follow_redirects=True)
+            html = client.get("/").get_data(as_text=True)
+            token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"',
+                html).group(1)
 
-            html = resp.get_data(as_text=True)
+            resp = client.post("/logout", data={"csrf_token": "nope"})
+            self.assertIn(CURR_USER_KEY, session)
 
-            self.assertIn(user.get_full_name(), html)
-            self.assertTrue(session.get(CURR_USER_KEY))
+            resp = client.post("/logout", data={"csrf_token": token})
+            self.assertNotIn(CURR_USER_KEY, session)
 
 
 #######################################
@@ -710,6 +2246,440 @@ class LikeViewsTestCase(TestCase):
             self.assertEqual(json, {"unliked" : self.cafe_id})
             self.assertEqual(resp.status_code, 201)
 
+    def test_put_like(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.put(f"/api/cafes/{self.cafe_id}/like")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_json(), {"liked": True, "count": 1})
+            self.assertEqual(db.session.get(User, self.user_id).likes_version, 1)
+
+            # liking again changes nothing
+            resp = client.put(f"/api/cafes/{self.cafe_id}/like")
+
+            self.assertEqual(resp.get_json(), {"liked": True, "count": 1})
+            self.assertEqual(db.session.get(User, self.user_id).likes_version, 1)
+
+    def test_delete_like(self):
+        Like.add(self.user_id, self.cafe_id)
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            for i in range(2):
+                resp = client.delete(f"/api/cafes/{self.cafe_id}/like")
+
+                self.assertEqual(resp.get_json(), {"liked": False, "count": 0})
+
+            self.assertIsNone(db.session.get(Like, (self.user_id, self.cafe_id)))
+            self.assertEqual(db.session.get(User, self.user_id).likes_version, 1)
+
+    def test_like_missing_cafe(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.put("/api/cafes/0/like")
+            self.assertEqual(resp.status_code, 404)
+
+            resp = client.delete("/api/cafes/0/like")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_like_logged_out(self):
+        with app.test_client() as client:
+            resp = client.put(f"/api/cafes/{self.cafe_id}/like")
+
+            self.assertEqual(resp.status_code, 401)
+
+    def test_like_statuses(self):
+        db.session.add(Like(user_id=self.user_id, cafe_id=self.cafe_id))
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.post("/api/likes/status",
+                json={"cafe_ids": [self.cafe_id, 0]})
+
+            self.assertEqual(resp.get_json(),
+                {"likes": {str(self.cafe_id): True, "0": False}})
+            self.assertEqual(int(resp.headers[QUERY_COUNT_HEADER]), 2)
+
+    def test_like_statuses_invalid(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            for data in [{}, {"cafe_ids": "1"}, {"cafe_ids": ["1"]},
+                    {"cafe_ids": list(range(501))}]:
+                resp = client.post("/api/likes/status", json=data)
+                self.assertEqual(resp.status_code, 400)
+
+            resp = client.post("/api/likes/status", json={"cafe_ids": []})
+            self.assertEqual(resp.get_json(), {"likes": {}})
+
+    def test_liked_ids(self):
+        self.assertIn(3, LikedIds([5, 3, 9]))
+        self.assertNotIn(4, LikedIds([5, 3, 9]))
+        self.assertNotIn(1, LikedIds([]))
+        self.assertEqual(list(LikedIds([5, 3, 9])), [3, 5, 9])
+
+    def test_liked_ids_cached_by_version(self):
+        user = db.session.get(User, self.user_id)
+
+        self.assertNotIn(self.cafe_id, liked_ids.get(user))
+
+        # without a version bump, the cached set is still used
+        db.session.add(Like(user_id=self.user_id, cafe_id=self.cafe_id))
+        db.session.commit()
+        hits = liked_ids.hits
+
+        self.assertNotIn(self.cafe_id, liked_ids.get(user))
+        self.assertEqual(liked_ids.hits, hits + 1)
+
+        user.likes_version += 1
+        db.session.commit()
+
+        self.assertIn(self.cafe_id, liked_ids.get(user))
+
+    def test_detail_shows_liked(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            html = client.get(f"/cafes/{self.cafe_id}").get_data(as_text=True)
+            self.assertRegex(html, r'"btn btn-outline-primary"\s+id="like-unlike"')
+
+            client.put(f"/api/cafes/{self.cafe_id}/like")
+
+            html = client.get(f"/cafes/{self.cafe_id}").get_data(as_text=True)
+            self.assertRegex(html, r'"btn btn-primary"\s+id="like-unlike"')
+
+
+class PopularCafesTestCase(TestCase):
+    """Tests for like counts and the most liked cafes."""
+
+    def setUp(self):
+        """Before each test, add cafes and users who like some of them."""
+
+        Like.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafes = [Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}) for i in range(3)]
+        users = [User.register(**{**TEST_USER_DATA, "username": f"u{i}",
+            "email": f"u{i}@test.com"}) for i in range(2)]
+        db.session.add_all(cafes + users)
+        db.session.commit()
+
+        self.cafe_ids = [cafe.id for cafe in cafes]
+        self.user_ids = [user.id for user in users]
+
+        # cafe 1 is liked twice, cafe 0 once, cafe 2 not at all
+        for user_id, cafe_id in [(self.user_ids[0], self.cafe_ids[1]),
+                (self.user_ids[1], self.cafe_ids[1]),
+                (self.user_ids[0], self.cafe_ids[0])]:
+            Like.add(user_id, cafe_id)
+        db.session.commit()
+
+    def tearDown(self):
+        """After each test, remove all cafes and users."""
+
+        Like.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_counts_kept(self):
+        cafe = db.session.get(Cafe, self.cafe_ids[1])
+        version, updated_at = cafe.version, cafe.updated_at
+
+        self.assertEqual(cafe.like_count, 2)
+
+        Like.remove(self.user_ids[0], self.cafe_ids[1])
+        db.session.commit()
+
+        cafe = db.session.get(Cafe, self.cafe_ids[1])
+        self.assertEqual(cafe.like_count, 1)
+        self.assertEqual(cafe.version, version)
+        self.assertEqual(cafe.updated_at, updated_at)
+
+    def test_popular_page(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes/popular")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertLess(html.index("Cafe 1"), html.index("Cafe 0"))
+            self.assertIn("2 likes", html)
+            self.assertNotIn("Cafe 2", html)
+
+    def test_popular_api(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes/popular",
+                query_string={"fields": "id", "limit": 1})
+
+            self.assertEqual(resp.get_json(),
+                {"cafes": [{"id": self.cafe_ids[1], "like_count": 2}]})
+
+    def test_reconcile(self):
+        # likes added around Like.add aren't counted
+        db.session.add(Like(user_id=self.user_ids[1], cafe_id=self.cafe_ids[2]))
+        Like.query.filter_by(cafe_id=self.cafe_ids[0]).delete()
+        db.session.commit()
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["likes", "reconcile", "--dry-run"])
+
+        self.assertIn(f"Cafe {self.cafe_ids[0]}: 1 likes counted, 0 actual",
+            result.output)
+        self.assertIn("2 cafes drifted, off by 2 likes", result.output)
+        self.assertEqual(db.session.get(Cafe, self.cafe_ids[2]).like_count, 0)
+
+        result = runner.invoke(args=["likes", "reconcile"])
+
+        self.assertIn("Fixed", result.output)
+        db.session.expire_all()
+        self.assertEqual(
+            [db.session.get(Cafe, id).like_count for id in self.cafe_ids],
+            [0, 2, 1])
+
+        result = runner.invoke(args=["likes", "reconcile"])
+
+        self.assertIn("0 cafes drifted", result.output)
+
+
+class TrendingCafesTestCase(TestCase):
+    """Tests for time-decayed like scores."""
+
+    def setUp(self):
+        """Before each test, add cafes in two cities and users."""
+
+        Like.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        cafes = [Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}) for i in range(2)]
+        cafes.append(Cafe(**{**CAFE_DATA, "name": "Oak Cafe",
+            "city_code": "oak"}))
+        users = [User.register(**{**TEST_USER_DATA, "username": f"u{i}",
+            "email": f"u{i}@test.com"}) for i in range(3)]
+        db.session.add_all(cafes + users)
+        db.session.commit()
+
+        self.cafe_ids = [cafe.id for cafe in cafes]
+        self.user_ids = [user.id for user in users]
+
+        # cafe 0 was liked twice, two weeks ago; cafe 1 & oak once, today
+        two_weeks_ago = datetime.utcnow() - timedelta(days=14)
+        db.session.add_all([
+            Like(user_id=self.user_ids[0], cafe_id=self.cafe_ids[0],
+                created_at=two_weeks_ago),
+            Like(user_id=self.user_ids[1], cafe_id=self.cafe_ids[0],
+                created_at=two_weeks_ago),
+            Like(user_id=self.user_ids[0], cafe_id=self.cafe_ids[1]),
+            Like(user_id=self.user_ids[0], cafe_id=self.cafe_ids[2]),
+        ])
+        db.session.commit()
+
+        trending.reset()
+
+    def tearDown(self):
+        """After each test, remove all cafes and users."""
+
+        Like.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_decayed(self):
+        top = trending.top(10, "sf")
+
+        self.assertEqual([id for id, score in top],
+            [self.cafe_ids[1], self.cafe_ids[0]])
+        # two likes two half-lives ago are worth half of one like today
+        self.assertAlmostEqual(top[0][1], 1, places=3)
+        self.assertAlmostEqual(top[1][1], 0.5, places=3)
+
+    def test_kept_current(self):
+        trending.top(10)
+
+        Like.add(self.user_ids[2], self.cafe_ids[0])
+        Like.add(self.user_ids[2], self.cafe_ids[2])
+        Like.remove(self.user_ids[0], self.cafe_ids[1])
+        db.session.commit()
+
+        top = dict(trending.top(10))
+
+        self.assertAlmostEqual(top[self.cafe_ids[0]], 1.5, places=3)
+        self.assertAlmostEqual(top[self.cafe_ids[2]], 2, places=3)
+        self.assertNotIn(self.cafe_ids[1], top)
+
+    def test_not_reloaded_on_like_or_unlike(self):
+        trending.top(10)
+
+        with patch.object(trending, "load") as mock_load:
+            Like.add(self.user_ids[2], self.cafe_ids[0])
+            db.session.commit()
+            Like.remove(self.user_ids[2], self.cafe_ids[0])
+            db.session.commit()
+            trending.top(10)
+
+        mock_load.assert_not_called()
+
+    def test_rolled_back(self):
+        trending.top(10)
+
+        Like.add(self.user_ids[2], self.cafe_ids[1])
+        db.session.rollback()
+
+        self.assertAlmostEqual(dict(trending.top(10))[self.cafe_ids[1]], 1,
+            places=3)
+
+    def test_cafe_moved(self):
+        trending.top(10)
+
+        cafe = db.session.get(Cafe, self.cafe_ids[1])
+        cafe.city_code = "oak"
+        db.session.commit()
+
+        self.assertEqual([id for id, score in trending.top(10, "sf")],
+            [self.cafe_ids[0]])
+        self.assertEqual(len(trending.top(10, "oak")), 2)
+
+    def test_trending_api(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes/trending",
+                query_string={"city": "oak", "fields": "id,name"})
+
+            self.assertEqual(resp.get_json(), {"cafes": [
+                {"id": self.cafe_ids[2], "name": "Oak Cafe", "score": 1.0}]})
+
+
+class RecommendationsTestCase(TestCase):
+    """Tests for "people who liked this also liked"."""
+
+    def setUp(self):
+        """Before each test, add cafes and users who like some of them."""
+
+        Like.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafes = [Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}) for i in range(4)]
+        users = [User.register(**{**TEST_USER_DATA, "username": f"u{i}",
+            "email": f"u{i}@test.com"}) for i in range(3)]
+        db.session.add_all(cafes + users)
+        db.session.commit()
+
+        self.cafe_ids = c = [cafe.id for cafe in cafes]
+        self.user_ids = u = [user.id for user in users]
+
+        # cafes 0 & 1 are both liked by two users, 0 & 2 by one
+        for user_id, cafe_id in [(u[0], c[0]), (u[0], c[1]), (u[1], c[0]),
+                (u[1], c[1]), (u[1], c[2])]:
+            Like.add(user_id, cafe_id)
+
+        rebuild_neighbors()
+        db.session.commit()
+
+    def tearDown(self):
+        """After each test, remove all cafes and users."""
+
+        Like.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def similar(self, cafe_id):
+        return [(row.id, row.co_likes) for row in get_similar_cafes(cafe_id)]
+
+    def test_build_neighbors(self):
+        rows = build_neighbors([1, 1, 2, 2, 2, 3], [10, 20, 10, 20, 30, 40], k=1)
+
+        self.assertEqual([row[:2] for row in rows], [(10, 20), (20, 10), (30, 10)])
+        self.assertAlmostEqual(rows[0][2], 1.0)
+        self.assertAlmostEqual(rows[2][2], 1 / 2 ** 0.5)
+        self.assertEqual(rows[0][3], 2)
+
+    def test_rebuilt(self):
+        c = self.cafe_ids
+
+        self.assertEqual(self.similar(c[0]), [(c[1], 2), (c[2], 1)])
+        self.assertEqual(self.similar(c[3]), [])
+
+    def test_updated_on_like(self):
+        c, u = self.cafe_ids, self.user_ids
+
+        with app.test_client() as client:
+            login_for_test(client, u[2])
+            client.put(f"/api/cafes/{c[2]}/like")
+            client.put(f"/api/cafes/{c[3]}/like")
+
+        self.assertEqual(self.similar(c[3]), [(c[2], 1)])
+        # other pairs' scores are only refreshed by a rebuild
+        self.assertCountEqual(self.similar(c[2]),
+            [(c[3], 1), (c[0], 1), (c[1], 1)])
+
+        with app.test_client() as client:
+            login_for_test(client, u[1])
+            client.delete(f"/api/cafes/{c[2]}/like")
+
+        self.assertEqual(self.similar(c[0]), [(c[1], 2)])
+        self.assertEqual(self.similar(c[2]), [(c[3], 1)])
+
+    def test_like_with_drifted_counts(self):
+        c, u = self.cafe_ids, self.user_ids
+
+        # a like that didn't update like_count
+        user = User.query.get(u[2])
+        user.liked_cafes.append(Cafe.query.get(c[3]))
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, u[2])
+            resp = client.put(f"/api/cafes/{c[2]}/like")
+
+            self.assertEqual(resp.status_code, 200)
+
+        self.assertEqual(self.similar(c[3]), [(c[2], 1)])
+        self.assertLessEqual(get_similar_cafes(c[3])[0].score, 1)
+
+    def test_detail_and_api(self):
+        c = self.cafe_ids
+
+        with app.test_client() as client:
+            html = client.get(f"/cafes/{c[0]}").get_data(as_text=True)
+
+            self.assertIn("People who liked this also liked", html)
+            self.assertIn(f'href="/cafes/{c[1]}">Cafe 1', html)
+
+            resp = client.get(f"/api/cafes/{c[0]}/similar")
+
+            self.assertEqual([cafe["id"] for cafe in resp.get_json()["cafes"]],
+                [c[1], c[2]])
+            self.assertEqual(client.get("/api/cafes/0/similar").status_code,
+                404)
+
+    def test_build_command(self):
+        CafeNeighbor.query.delete()
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=["recs", "build"])
+
+        self.assertIn("Stored 6 similar cafes", result.output)
+        self.assertEqual(len(self.similar(self.cafe_ids[0])), 2)
+
 
 # potential further study -- add ability to unlike cafes from profile page
     # maybe add an edit list button that redirects to a list of cafes and you
@@ -0,0 +1,121 @@
+"""Trending cafes: the most liked lately, with older likes counting less.
+
+Each like adds a weight that halves every HALF_LIFE_DAYS. Rather than
+decaying every score as time passes, a like's weight is computed once
+relative to a fixed epoch (later likes weigh more), which ranks cafes the
+same way; scores are scaled back to the present when they're read. The
+epoch is moved up whenever the index reloads, so weights stay small.
+
+Scores are kept in memory and updated as likes are committed. Loading only
+reads likes from the last few half-lives, whose weight still matters.
+"""
+
+import heapq
+import math
+from datetime import datetime, timedelta
+
+from indexes import SyncedIndex, get_identity
+from models import db, Cafe, Like
+
+HALF_LIFE_DAYS = 7
+
+# likes older than this many half-lives (weight < 1/256) are left out
+WINDOW_HALF_LIVES = 8
+
+
+class TrendingIndex(SyncedIndex):
+    """Decayed like scores of cafes, by city."""
+
+    models = (Like, Cafe)
+
+    # reloading re-reads recent likes & moves the epoch forward
+    max_age = 3600
+
+    def __init__(self, half_life_days=HALF_LIFE_DAYS):
+        super().__init__()
+        self.decay_seconds = half_life_days * 86400 / math.log(2)
+        self.epoch = datetime.utcnow()
+        self.scores = {}
+        self.city_scores = {}
+        self.cafe_cities = {}
+
+    def weight(self, created_at):
+        """Return the weight of a like made at created_at, relative to the
+        epoch."""
+
+        age = (self.epoch - created_at).total_seconds()
+        return math.exp(-age / self.decay_seconds)
+
+    def load(self):
+        self.epoch = datetime.utcnow()
+        self.scores = {}
+        self.city_scores = {}
+        self.cafe_cities = dict(db.session.execute(
+            db.select(Cafe.id, Cafe.city_code)).all())
+
+        cutoff = self.epoch - timedelta(
+            seconds=self.decay_seconds * math.log(2) * WINDOW_HALF_LIVES)
+        query = (db.select(Like.cafe_id, Like.created_at)
+            .where(Like.created_at > cutoff)
+            .execution_options(yield_per=10000))
+
+        for cafe_id, created_at in db.session.execute(query):
+            self.add_score(cafe_id, self.weight(created_at))
+
+    def add_score(self, cafe_id, change):
+        """Add change to cafe's score, in all cafes and in its city."""
+
+        city_scores = self.city_scores.setdefault(
+            self.cafe_cities.get(cafe_id), {})
+
+        for scores in (self.scores, city_scores):
+            score = scores.get(cafe_id, 0) + change
+
+            # unliking can leave a little rounding error instead of 0
+            if score > 1e-9:
+                scores[cafe_id] = score
+            else:
+                scores.pop(cafe_id, None)
+
+    def snapshot(self, op, obj):
+        if isinstance(obj, Like):
+            return "like", obj.cafe_id, obj.created_at
+        if op == "delete":
+            return "cafe", get_identity(obj), None
+        return "cafe", obj.id, obj.city_code
+
+    def apply(self, op, data):
+        kind, cafe_id, value = data
+
+        if kind == "like":
+            weight = self.weight(value)
+            self.add_score(cafe_id, -weight if op == "delete" else weight)
+            return
+
+        # a new, moved or deleted cafe: move its score to its new city
+        score = self.scores.get(cafe_id, 0)
+        self.add_score(cafe_id, -score)
+
+        if value is None:
+            self.cafe_cities.pop(cafe_id, None)
+        else:
+            self.cafe_cities[cafe_id] = value
+            self.add_score(cafe_id, score)
+
+    def top(self, limit, city_code=None):
+        """Return [(cafe id, score)] of the limit highest scoring cafes,
+        optionally only in one city, with scores as of now."""
+
+        self.ensure_loaded()
+
+        with self._lock:
+            scores = (self.scores if city_code is None
+                else self.city_scores.get(city_code, {}))
+            top = heapq.nlargest(limit, scores.items(),
+                key=lambda item: item[1])
+            now = self.weight(datetime.utcnow())
+
+        return [(cafe_id, score / now) for cafe_id, score in top]
+
+
+trending = TrendingIndex()
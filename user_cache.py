@@ -0,0 +1,71 @@
+"""Logged in users, cached between requests.
+
+Most requests only need a few of the user's columns (for the navbar, ETags
+and permission checks), so only those are loaded; the rest load on first
+use. Users are kept in a small TTL cache and attached to each request's
+session without a query. Anything that changes a user should call forget().
+
+likes_version isn't cached: forget() only reaches this process's cache, and
+liked cafe ids & ETags are keyed on it, so it's read fresh (on first use)
+every request.
+"""
+
+from sqlalchemy.orm import load_only, make_transient_to_detached
+
+from models import db, User
+
+# what most pages use of the user, and can be a little out of date
+USER_COLUMNS = (User.id, User.username, User.first_name, User.last_name,
+    User.admin)
+
+
+class UserCache:
+    """Users by id, in a cache backend like cache.LRUCache."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.stats = {"hits": 0, "misses": 0, "not_needed": 0}
+
+    def get(self, user_id):
+        """Return user with this id, in the current session, or None."""
+
+        cached = self.backend.get(user_id)
+
+        if cached is not None:
+            self.stats["hits"] += 1
+            return db.session.merge(cached, load=False)
+
+        self.stats["misses"] += 1
+
+        user = db.session.get(User, user_id,
+            options=[load_only(*USER_COLUMNS, User.likes_version)])
+
+        if user is not None:
+            # cache a detached copy, as user belongs to this request's session
+            copy = User(**{column.key: getattr(user, column.key)
+                for column in USER_COLUMNS})
+            make_transient_to_detached(copy)
+            self.backend.set(user_id, copy)
+
+        return user
+
+    def forget(self, user_id):
+        """Drop user from the cache, so they're loaded again next time."""
+
+        self.backend.delete(user_id)
+
+    def count_not_needed(self):
+        """Count a request by a logged in user that never used the user."""
+
+        self.stats["not_needed"] += 1
+
+    def get_stats(self):
+        """Return dict of counts of requests that loaded the user, got them
+        from the cache, or didn't need them, and the share not queried."""
+
+        stats = dict(self.stats)
+        lookups = sum(stats.values())
+        stats["avoided_rate"] = (
+            (stats["hits"] + stats["not_needed"]) / lookups
+            if lookups else None)
+        return stats
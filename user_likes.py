@@ -0,0 +1,69 @@
+"""Sets of the cafes each user likes, for quick "is this liked?" checks.
+
+A user's liked cafe ids are read with one id-only query into a sorted
+array of ints (4 bytes a cafe, rather than a Cafe object each), and cached
+under the user's likes_version, which is bumped on every like and unlike,
+so a changed set is read again rather than needing to be found & deleted.
+"""
+
+import bisect
+from array import array
+
+from cache import LRUCache
+from models import db, Like
+
+
+class LikedIds:
+    """Sorted, compact set of cafe ids."""
+
+    def __init__(self, ids):
+        self.ids = array('i', sorted(ids))
+
+    def __contains__(self, cafe_id):
+        i = bisect.bisect_left(self.ids, cafe_id)
+        return i < len(self.ids) and self.ids[i] == cafe_id
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class LikedIdsCache:
+    """Users' liked cafe ids, by user id & likes_version."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user):
+        """Return LikedIds of the cafes user likes."""
+
+        key = (user.id, user.likes_version)
+        liked = self.backend.get(key)
+
+        if liked is None:
+            self.misses += 1
+            liked = LikedIds(db.session.scalars(
+                db.select(Like.cafe_id).where(Like.user_id == user.id)))
+            self.backend.set(key, liked)
+        else:
+            self.hits += 1
+
+        return liked
+
+    def get_stats(self):
+        """Return dict of hit/miss counts and hit rate."""
+
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "size": len(self.backend),
+        }
+
+
+liked_ids = LikedIdsCache(LRUCache(max_size=10000))